@@ -1,22 +1,74 @@
+import asyncio
 import datetime
 import logging
+import math
 import os
-import time
-from typing import List
+from typing import AsyncIterator, Callable, List, NamedTuple, Optional, Tuple
+from urllib.parse import quote_plus, urlencode
 
 import dotenv
-import requests
+import httpx
 
-from utils import hyphenate_citizen_id
+from metrics import (airtable_rate_limit_wait_seconds, airtable_request_seconds,
+                     airtable_requests_total)
+from ratelimit import RateLimitBlockedError, airtable_rate_limiter
+from utils import UTC, hyphenate_citizen_id
 
 dotenv.load_dotenv()
 
 AIRTABLE_API_KEY = os.environ.get('AIRTABLE_API_KEY')
 AIRTABLE_BASE_ID = os.environ.get('AIRTABLE_BASE_ID')
 AIRTABLE_TABLE_NAME = "Care%20Requests"
-AIRTABLE_BASE_URL = f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{AIRTABLE_TABLE_NAME}"
+# Overridable to point the shim at a stand-in server, e.g. benchmarks/fake_servers.py
+AIRTABLE_BASE_URL = os.environ.get('AIRTABLE_BASE_URL',
+                                   f"https://api.airtable.com/v0/{AIRTABLE_BASE_ID}/{AIRTABLE_TABLE_NAME}")
 AIRTABLE_AUTH_HEADER = {"Authorization": f"Bearer {AIRTABLE_API_KEY}"}
-AIRTABLE_REQUEST_DELAY = 0.5
+AIRTABLE_REQUEST_TIMEOUT = 30
+AIRTABLE_MAX_RETRIES = int(os.environ.get('AIRTABLE_MAX_RETRIES', 3))
+# Airtable rejects request URLs longer than 16,000 characters
+AIRTABLE_MAX_URL_LENGTH = int(os.environ.get('AIRTABLE_MAX_URL_LENGTH', 16000))
+# Airtable asks clients to wait 30 seconds after a 429 when no Retry-After is given
+AIRTABLE_RATE_LIMIT_BACKOFF = 30
+AIRTABLE_MAX_CONNECTIONS = int(os.environ.get('AIRTABLE_MAX_CONNECTIONS', 10))
+# Airtable updates at most 10 records per request
+AIRTABLE_PATCH_BATCH_SIZE = 10
+AIRTABLE_PATCH_CONCURRENCY = int(os.environ.get('AIRTABLE_PATCH_CONCURRENCY', 4))
+AIRTABLE_PATCH_MAX_ATTEMPTS = int(os.environ.get('AIRTABLE_PATCH_MAX_ATTEMPTS', 5))
+AIRTABLE_PATCH_BACKOFF = 0.5
+AIRTABLE_PAGE_SIZE = 100
+# Offset pagination fetches one page per round trip. With AIRTABLE_SCAN_PARTITIONS set, large /requests scans are
+# split into windows on AIRTABLE_SCAN_FIELD instead, at most this many at a time, which are paged through
+# concurrently within the rate limit.
+AIRTABLE_SCAN_PARTITIONS = int(os.environ.get('AIRTABLE_SCAN_PARTITIONS', 0))
+AIRTABLE_SCAN_CONCURRENCY = int(os.environ.get('AIRTABLE_SCAN_CONCURRENCY', 4))
+AIRTABLE_SCAN_FIELD = os.environ.get('AIRTABLE_SCAN_FIELD', 'Last Status Change Datetime')
+# Every window ends in a part-filled page, fewer and larger windows waste less of the rate limit on them
+AIRTABLE_SCAN_WINDOW_PAGES = int(os.environ.get('AIRTABLE_SCAN_WINDOW_PAGES', 3))
+
+# One pooled keep-alive client per process (i.e. per gunicorn worker), created lazily on first use
+_airtable_client: Optional[httpx.AsyncClient] = None
+
+
+class AirtableRateLimitError(ConnectionError):
+    pass
+
+
+def get_airtable_client() -> httpx.AsyncClient:
+    global _airtable_client
+    if _airtable_client is None or _airtable_client.is_closed:
+        _airtable_client = httpx.AsyncClient(
+            headers=AIRTABLE_AUTH_HEADER,
+            timeout=AIRTABLE_REQUEST_TIMEOUT,
+            limits=httpx.Limits(max_connections=AIRTABLE_MAX_CONNECTIONS,
+                                max_keepalive_connections=AIRTABLE_MAX_CONNECTIONS))
+    return _airtable_client
+
+
+async def close_airtable_client():
+    global _airtable_client
+    if _airtable_client is not None:
+        await _airtable_client.aclose()
+        _airtable_client = None
 
 
 def build_airtable_formula_chain(formula: str, expressions: List[str]) -> str:
@@ -24,7 +76,40 @@ def build_airtable_formula_chain(formula: str, expressions: List[str]) -> str:
         return ''
     if len(expressions) == 1:
         return expressions[0]
-    return f"{formula}({expressions[0]},{build_airtable_formula_chain(formula, expressions[1:])})"
+    # OR() and AND() are variadic, so the chain stays flat however many expressions there are
+    return f"{formula}({','.join(expressions)})"
+
+
+def escape_airtable_string(value: str) -> str:
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def build_airtable_match_expression(field: str, value: str) -> str:
+    return f"{{{field}}}={escape_airtable_string(value)}"
+
+
+def get_encoded_length(params) -> int:
+    return len(AIRTABLE_BASE_URL) + 1 + len(urlencode(params))
+
+
+def pack_expressions_into_url_budget(expressions: List[str], fixed_length: int,
+                                     max_url_length: int = AIRTABLE_MAX_URL_LENGTH) -> List[List[str]]:
+    # Each expression costs its URL-encoded length plus an encoded comma separating it from the next one
+    separator_length = len(quote_plus(','))
+    batches = []
+    batch = []
+    length = fixed_length
+    for expression in expressions:
+        expression_length = len(quote_plus(expression)) + separator_length
+        if len(batch) > 0 and length + expression_length > max_url_length:
+            batches.append(batch)
+            batch = []
+            length = fixed_length
+        batch.append(expression)
+        length += expression_length
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
 
 
 def build_airtable_datetime_expression(_datetime: datetime.datetime,
@@ -37,56 +122,298 @@ def build_airtable_datetime_expression(_datetime: datetime.datetime,
     return f"DATETIME_PARSE(\"{_datetime.strftime('%Y %m %d %H %M %S %z')}\",\"YYYY MM DD HH mm ss ZZ\",\"ms\")"
 
 
-def get_airtable_records(params) -> List:
-    response = requests.get(AIRTABLE_BASE_URL, headers=AIRTABLE_AUTH_HEADER, params=params)
+def build_airtable_modified_since_formula(modified_since: datetime.datetime) -> str:
+    return f"IS_AFTER(LAST_MODIFIED_TIME(),{build_airtable_datetime_expression(modified_since, datetime.timezone.utc)})"
+
+
+def get_retry_after(response: httpx.Response) -> Optional[float]:
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
 
-    if response.status_code != requests.codes.OK:
+async def request_airtable(method: str, params=None, json=None, wait_for_rate_limit: bool = True) -> httpx.Response:
+    client = get_airtable_client()
+    # Without waiting, a 429 or a backoff already in force is handed back to the caller instead of sitting it out
+    max_retries = AIRTABLE_MAX_RETRIES if wait_for_rate_limit else 0
+    for attempt in range(max_retries + 1):
+        try:
+            queue_wait = await airtable_rate_limiter.acquire(wait_while_blocked=wait_for_rate_limit)
+        except RateLimitBlockedError as e:
+            raise AirtableRateLimitError(f'Airtable rate limit exceeded: {e}.')
+        airtable_rate_limit_wait_seconds.observe(queue_wait, method=method)
+        logging.info(f'Airtable {method} waited {queue_wait:.3f}s in the rate limit queue.')
+        try:
+            with airtable_request_seconds.time(method=method):
+                response = await client.request(method, AIRTABLE_BASE_URL, params=params, json=json)
+        except httpx.HTTPError as e:
+            airtable_requests_total.inc(method=method, status=type(e).__name__)
+            raise
+        airtable_requests_total.inc(method=method, status=response.status_code)
+        if response.status_code != httpx.codes.TOO_MANY_REQUESTS:
+            return response
+        retry_after = get_retry_after(response)
+        backoff = retry_after if retry_after is not None else AIRTABLE_RATE_LIMIT_BACKOFF * 2 ** attempt
+        logging.warn(f'Airtable rate limit exceeded, backing off all workers for {backoff}s.')
+        await airtable_rate_limiter.block_for(backoff)
+    return response
+
+
+async def get_airtable_record_page(params, wait_for_rate_limit: bool = True) -> dict:
+    response = await request_airtable('GET', params=params, wait_for_rate_limit=wait_for_rate_limit)
+    if response.status_code == httpx.codes.TOO_MANY_REQUESTS:
+        raise AirtableRateLimitError('Unable to retrieve data from Airtable: Rate limit exceeded.')
+    if response.status_code != httpx.codes.OK:
         raise ConnectionError(f'Unable to retrieve data from Airtable: Error HTTP{response.status_code}.')
+    return response.json()
+
 
-    results = response.json()
-    records = results.get('records', [])
+async def iter_airtable_record_pages(params, wait_for_rate_limit: bool = True) -> AsyncIterator[List]:
+    results = await get_airtable_record_page(params, wait_for_rate_limit)
+    record_count = len(results.get('records', []))
+    yield results.get('records', [])
     # Loop to handle multi-page query
     while results.get('offset'):
-        time.sleep(AIRTABLE_REQUEST_DELAY)
-        response = requests.get(
-            AIRTABLE_BASE_URL,
-            headers=AIRTABLE_AUTH_HEADER,
-            params={'offset': results.get('offset')})
         logging.warn(
             f'Executing multi-page query... ' +
-            f'Currently on page {len(records) // 100}. Got {len(records)} records so far.')
-        results = response.json()
-        records += results['records']
+            f'Currently on page {record_count // 100}. Got {record_count} records so far.')
+        results = await get_airtable_record_page({'offset': results.get('offset')}, wait_for_rate_limit)
+        record_count += len(results['records'])
+        yield results['records']
+
+
+class ScanWindow(NamedTuple):
+    start: Optional[datetime.datetime]
+    end: Optional[datetime.datetime]
+    blank: bool = False
+
+
+def parse_airtable_timestamp(value) -> Optional[datetime.datetime]:
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo=UTC)
+    except (TypeError, ValueError):
+        return None
+
+
+def is_projected_without(params: list, field: str) -> bool:
+    fields = [value for key, value in params if key == 'fields[]']
+    return len(fields) > 0 and field not in fields
+
+
+def build_scan_window_params(params: list, field: str, window: ScanWindow) -> list:
+    expressions = [value for key, value in params if key == 'filterByFormula']
+    if window.blank:
+        expressions.append(f'{{{field}}}=BLANK()')
+    # Bounds are whole seconds compared in milliseconds, so that adjacent windows neither overlap nor leave a gap
+    if window.start is not None:
+        expressions.append(
+            f'DATETIME_DIFF({{{field}}},{build_airtable_datetime_expression(window.start, UTC)},"ms") >= 0')
+    if window.end is not None:
+        expressions.append(
+            f'DATETIME_DIFF({{{field}}},{build_airtable_datetime_expression(window.end, UTC)},"ms") < 0')
+
+    window_params = [(key, value) for key, value in params if key != 'filterByFormula']
+    # Windows are split on the field, so a projection has to include it
+    if is_projected_without(params, field):
+        window_params.append(('fields[]', field))
+    window_params += [('sort[0][field]', field), ('sort[0][direction]', 'asc')]
+    if len(expressions) > 0:
+        window_params.append(('filterByFormula', build_airtable_formula_chain('AND', expressions)))
+    return window_params
+
+
+def split_scan_window(window: ScanWindow, page: List, field: str) -> Optional[Tuple[List, List[ScanWindow]]]:
+    # The first page of a window sorted on the field holds every record before the second of its last one. The rest
+    # of the window is split into windows of a few pages each at the density seen so far, and those that turn out
+    # denser are split again.
+    timestamps = [parse_airtable_timestamp(record['fields'].get(field)) for record in page]
+    if len(page) == 0 or timestamps[-1] is None:
+        return None
+    split_at = timestamps[-1].replace(microsecond=0)
+    start = window.start or min(timestamp for timestamp in timestamps if timestamp is not None)
+    if split_at <= start:
+        # A page of records all within one second, the rest of the window is paged through as is, as is a window
+        # with only a few pages left
+        return None
+
+    records = [record for record, timestamp in zip(page, timestamps) if timestamp is not None and timestamp < split_at]
+    end = window.end or max(datetime.datetime.now(UTC), split_at + datetime.timedelta(seconds=1))
+    span = (end - split_at).total_seconds()
+    estimated_pages = len(records) * span / (split_at - start).total_seconds() / AIRTABLE_PAGE_SIZE
+    if estimated_pages <= AIRTABLE_SCAN_WINDOW_PAGES:
+        return None
+    count = max(1, min(AIRTABLE_SCAN_PARTITIONS, math.ceil(estimated_pages / AIRTABLE_SCAN_WINDOW_PAGES), int(span)))
+    bounds = [split_at + datetime.timedelta(seconds=int(span / count * i)) for i in range(count)] + [window.end]
+    windows = [ScanWindow(bounds[i], bounds[i + 1]) for i in range(count)]
+    if window.start is None and window.end is None:
+        # Records without a value for the field fall outside every bounded window, and sort before all the others
+        windows.insert(0, ScanWindow(None, None, blank=True))
+    return records, windows
+
+
+async def iter_partitioned_airtable_record_pages(params, field: str = AIRTABLE_SCAN_FIELD,
+                                                 wait_for_rate_limit: bool = True) -> AsyncIterator[List]:
+    semaphore = asyncio.Semaphore(AIRTABLE_SCAN_CONCURRENCY)
+    strip_field = is_projected_without(params, field)
+    scans = []
+
+    # Every window puts its pages on a queue of its own, in order, followed by None once it is done. A window that is
+    # split puts the queues of the windows that replace it in their place. Queues hold a few pages at most, windows
+    # that get ahead of the one being read wait for it rather than piling up pages.
+    async def scan_window(window: ScanWindow, pages: asyncio.Queue):
+        try:
+            async with semaphore:
+                results = await get_airtable_record_page(build_scan_window_params(params, field, window),
+                                                         wait_for_rate_limit)
+            split = split_scan_window(window, results.get('records', []), field) if results.get('offset') else None
+            if split is not None:
+                records, windows = split
+                child_pages = [start_scan(window) for window in windows]
+                for window, queue in zip(windows, child_pages):
+                    if window.blank:
+                        await pages.put(queue)
+                await pages.put(records)
+                for window, queue in zip(windows, child_pages):
+                    if not window.blank:
+                        await pages.put(queue)
+            else:
+                await pages.put(results.get('records', []))
+                while results.get('offset'):
+                    async with semaphore:
+                        results = await get_airtable_record_page({'offset': results.get('offset')}, wait_for_rate_limit)
+                    await pages.put(results.get('records', []))
+            await pages.put(None)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await pages.put(e)
+
+    def start_scan(window: ScanWindow) -> asyncio.Queue:
+        pages = asyncio.Queue(AIRTABLE_SCAN_WINDOW_PAGES)
+        scans.append(asyncio.ensure_future(scan_window(window, pages)))
+        return pages
+
+    async def iter_window_pages(pages: asyncio.Queue) -> AsyncIterator[List]:
+        while True:
+            item = await pages.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            if isinstance(item, asyncio.Queue):
+                async for page in iter_window_pages(item):
+                    yield page
+            else:
+                yield item
+
+    record_ids = set()
+    try:
+        async for page in iter_window_pages(start_scan(ScanWindow(None, None))):
+            # A record whose field changes during the scan can move into a window that is yet to be read
+            page = [record for record in page if record['id'] not in record_ids]
+            record_ids.update(record['id'] for record in page)
+            if strip_field:
+                for record in page:
+                    record['fields'].pop(field, None)
+            yield page
+        logging.info(f'Scanned {len(record_ids)} records from Airtable in {len(scans)} windows.')
+    finally:
+        for scan in scans:
+            scan.cancel()
+
+
+def iter_airtable_scan_pages(params, wait_for_rate_limit: bool = True) -> AsyncIterator[List]:
+    if AIRTABLE_SCAN_PARTITIONS > 0:
+        return iter_partitioned_airtable_record_pages(params, wait_for_rate_limit=wait_for_rate_limit)
+    return iter_airtable_record_pages(params, wait_for_rate_limit)
+
+
+async def get_airtable_records(params, partitioned: bool = False, wait_for_rate_limit: bool = True) -> List:
+    records = []
+    async for page in (iter_airtable_scan_pages(params, wait_for_rate_limit) if partitioned
+                       else iter_airtable_record_pages(params, wait_for_rate_limit)):
+        records += page
     return records
 
 
-def get_citizen_id_matched_airtable_records(citizen_ids: List[str]) -> List:
-    RECORDS_PER_REQUEST = 100
+async def patch_airtable_records(records: List) -> httpx.Response:
+    return await request_airtable('PATCH', json={'records': records})
+
+
+async def patch_airtable_record_batch(records: List, semaphore: asyncio.Semaphore) -> Tuple[List, List]:
+    async with semaphore:
+        for attempt in range(AIRTABLE_PATCH_MAX_ATTEMPTS):
+            try:
+                response = await patch_airtable_records(records)
+            except httpx.HTTPError as e:
+                logging.warn(f'Unable to update a batch of {len(records)} records on Airtable: {e!r}')
+            else:
+                if response.status_code == httpx.codes.OK:
+                    return response.json().get('records', []), []
+                logging.warn(f'Unable to update a batch of {len(records)} records on Airtable: ' +
+                             f'Error HTTP{response.status_code}.')
+                # request_airtable has already retried a 429 with the shared backoff, and other client errors (e.g.
+                # 422 for an invalid value) fail the same way on every retry, so only 5xx are retried here
+                if response.status_code < 500:
+                    break
+            if attempt + 1 < AIRTABLE_PATCH_MAX_ATTEMPTS:
+                await asyncio.sleep(AIRTABLE_PATCH_BACKOFF * 2 ** attempt)
+    return [], records
+
+
+async def patch_airtable_records_in_batches(
+        records: List, on_batch_done: Optional[Callable[[List, List], None]] = None) -> Tuple[List, List]:
+    # Returns the records as written by Airtable and the requested updates that could not be written
+    semaphore = asyncio.Semaphore(AIRTABLE_PATCH_CONCURRENCY)
+
+    async def patch_batch(batch: List) -> Tuple[List, List]:
+        written, failed = await patch_airtable_record_batch(batch, semaphore)
+        if on_batch_done is not None:
+            on_batch_done(written, failed)
+        return written, failed
+
+    results = await asyncio.gather(*[
+        patch_batch(records[i:i + AIRTABLE_PATCH_BATCH_SIZE])
+        for i in range(0, len(records), AIRTABLE_PATCH_BATCH_SIZE)])
+    written_records = [record for written, _ in results for record in written]
+    failed_records = [record for _, failed in results for record in failed]
+    return written_records, failed_records
+
+
+def build_citizen_id_matched_params(citizen_id_expressions: List[str]) -> list:
+    datetime_expression = build_airtable_datetime_expression(datetime.datetime.now().astimezone(
+        datetime.timezone(datetime.timedelta(hours=7))),
+        datetime.timezone(datetime.timedelta(hours=7)), unit_specifier='d')
+    return [
+        ('fields[]', 'Citizen ID'),
+        ('fields[]', 'Care Status'),
+        ('fields[]', 'Care Provider Name'),
+        ('fields[]', 'Note'),
+        ('filterByFormula', build_airtable_formula_chain('AND', [
+            build_airtable_formula_chain('OR', citizen_id_expressions),
+            # Rejecting to update requests older than 21 days
+            f"DATETIME_DIFF({datetime_expression}," +
+            '{Request Datetime}) > 21',
+            '{Status}="FINISHED"'
+        ])),
+        ('sort[0][field]', 'Request Datetime'),
+        ('sort[0][direction]', 'asc'),
+    ]
+
+
+def batch_citizen_id_expressions(citizen_ids: List[str]) -> List[List[str]]:
+    citizen_id_expressions = list(dict.fromkeys(
+        build_airtable_match_expression('Citizen ID', hyphenate_citizen_id(citizen_id)) for citizen_id in citizen_ids))
+    fixed_length = get_encoded_length(build_citizen_id_matched_params([])) + len(quote_plus('OR()'))
+    return pack_expressions_into_url_budget(citizen_id_expressions, fixed_length)
+
+
+async def get_citizen_id_matched_airtable_records(citizen_ids: List[str]) -> List:
     matched_records = []
 
-    for i in range(0, len(citizen_ids), RECORDS_PER_REQUEST):
-        citizen_id_filter_str = build_airtable_formula_chain('OR', list(set(
-            map(lambda citizen_id: f"{{Citizen ID}}=\"{hyphenate_citizen_id(citizen_id)}\"",
-                citizen_ids[i:i + RECORDS_PER_REQUEST]))))
-        datetime_expression = build_airtable_datetime_expression(datetime.datetime.now().astimezone(
-            datetime.timezone(datetime.timedelta(hours=7))),
-            datetime.timezone(datetime.timedelta(hours=7)), unit_specifier='d')
-        params = [
-            ('fields[]', 'Citizen ID'),
-            ('fields[]', 'Care Status'),
-            ('fields[]', 'Care Provider Name'),
-            ('fields[]', 'Note'),
-            ('filterByFormula', build_airtable_formula_chain('AND', [
-                citizen_id_filter_str,
-                # Rejecting to update requests older than 21 days
-                f"DATETIME_DIFF({datetime_expression}," +
-                '{Request Datetime}) > 21',
-                '{Status}="FINISHED"'
-            ])),
-            ('sort[0][field]', 'Request Datetime'),
-            ('sort[0][direction]', 'asc'),
-        ]
-        records = get_airtable_records(params=params)
+    for citizen_id_expressions in batch_citizen_id_expressions(citizen_ids):
+        records = await get_airtable_records(params=build_citizen_id_matched_params(citizen_id_expressions))
         matched_records += records
 
     return matched_records
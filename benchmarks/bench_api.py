@@ -0,0 +1,210 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, List
+
+import requests
+
+# Runs read_requests, report_provided_care and poll_for_new_care_status_update against benchmarks/fake_servers.py.
+# Every scenario runs in a fresh process so that its peak RSS is its own, after reseeding the fake Airtable table.
+SIZES = (1000, 10000, 100000)
+SCENARIOS = ('read_requests', 'report_provided_care', 'poll_for_new_care_status_update')
+REPORTS_PER_REQUEST = 100
+API_KEY = 'benchmark'
+
+
+def percentile(samples: List[float], fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def get_peak_rss_mb() -> float:
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak_rss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+async def measure(iterations: int, run: Callable) -> dict:
+    # The first run warms up imports, caches and connections and is reported separately
+    started_at = time.perf_counter()
+    await run(0)
+    warmup_seconds = time.perf_counter() - started_at
+
+    samples = []
+    items = 0
+    for iteration in range(1, iterations + 1):
+        started_at = time.perf_counter()
+        items += await run(iteration)
+        samples.append(time.perf_counter() - started_at)
+    return {
+        'warmup_seconds': warmup_seconds,
+        'p50_seconds': percentile(samples, 0.5),
+        'p99_seconds': percentile(samples, 0.99),
+        'throughput': items / sum(samples),
+    }
+
+
+async def bench_read_requests(records: int, iterations: int) -> dict:
+    import httpx
+    from main import app
+
+    async with httpx.AsyncClient(app=app, base_url='http://shim', timeout=None) as client:
+        async def run(iteration: int) -> int:
+            response = await client.get('/requests', params={'token': API_KEY})
+            response.raise_for_status()
+            return len(response.json()['data'])
+
+        result = await measure(iterations, run)
+    result['unit'] = 'records/s'
+    return result
+
+
+async def bench_report_provided_care(records: int, iterations: int) -> dict:
+    import httpx
+    from main import app
+    from benchmarks.fake_servers import make_citizen_id
+
+    # Each run reports a different slice of citizens so that every run has records to update
+    stride = max(1, records // ((iterations + 1) * REPORTS_PER_REQUEST))
+
+    async with httpx.AsyncClient(app=app, base_url='http://shim', timeout=None) as client:
+        async def run(iteration: int) -> int:
+            reports = [{'citizen_id': make_citizen_id(i), 'care_provider_name': 'Benchmark Hospital'}
+                       for i in range(iteration * REPORTS_PER_REQUEST * stride,
+                                      (iteration + 1) * REPORTS_PER_REQUEST * stride, stride)]
+            response = await client.post('/care_provided_report', params={'token': API_KEY}, json=reports)
+            response.raise_for_status()
+            return len(reports)
+
+        result = await measure(iterations, run)
+    result['unit'] = 'reports/s'
+    return result
+
+
+async def bench_poll_for_new_care_status_update(records: int, iterations: int) -> dict:
+    from cron import CMC_API_BASE_URL, poll_for_new_care_status_update
+
+    fake_server_url = CMC_API_BASE_URL.rsplit('/', 1)[0]
+
+    async def run(iteration: int) -> int:
+        # The warm-up poll sees every row as new, later ones find 1% of the rows changed
+        if iteration > 0:
+            requests.post(f'{fake_server_url}/_fake/cmc/touch', params={'fraction': 0.01, 'seed': iteration})
+        await poll_for_new_care_status_update()
+        return records
+
+    result = await measure(iterations, run)
+    result['unit'] = 'rows/s'
+    return result
+
+
+def run_child(scenario: str, records: int, iterations: int):
+    from airtable import close_airtable_client
+
+    # The shim logs every partial update and multi-page query as a warning, keep errors only
+    logging.disable(logging.WARNING)
+
+    async def run() -> dict:
+        try:
+            return await globals()[f'bench_{scenario}'](records, iterations)
+        finally:
+            await close_airtable_client()
+
+    result = asyncio.get_event_loop().run_until_complete(run())
+    result['peak_rss_mb'] = get_peak_rss_mb()
+    print(json.dumps(result))
+
+
+def get_free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_fake_servers(port: int) -> subprocess.Popen:
+    server = subprocess.Popen([sys.executable, '-m', 'benchmarks.fake_servers', '--port', str(port), '--records', '0'],
+                              stdout=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            requests.get(f'http://127.0.0.1:{port}/_fake/stats').raise_for_status()
+            return server
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError('The fake servers did not start')
+
+
+def run_benchmarks(sizes: List[int], scenarios: List[str], iterations: int, output: str):
+    port = get_free_port()
+    fake_server_url = f'http://127.0.0.1:{port}'
+    server = start_fake_servers(port)
+    results = []
+
+    print(f"{'scenario':<32} {'records':>8} {'warm-up':>9} {'p50':>9} {'p99':>9} {'throughput':>20} " +
+          f"{'peak RSS':>9} {'Airtable calls':>15}")
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            env = dict(
+                os.environ,
+                AIRTABLE_BASE_URL=f'{fake_server_url}/v0/base/Care%20Requests',
+                CMC_API_BASE_URL=f'{fake_server_url}/cmc',
+                CMC_API_KEY=API_KEY,
+                BMA_API_KEY=API_KEY,
+                REQUESTS_CACHE_TTL='0',
+                REPLICA_DATABASE_PATH='',
+                CITIZEN_INDEX_DATABASE_PATH='',
+                AIRTABLE_RATE_LIMIT_FILE=os.path.join(directory, 'airtable-rate-limit'),
+                JOBS_DATABASE_PATH=os.path.join(directory, 'jobs.sqlite3'),
+            )
+            # The real 5 requests per second would make the large runs measure nothing but the rate limiter
+            env.setdefault('AIRTABLE_RATE_LIMIT', '1000')
+
+            for records in sizes:
+                for scenario in scenarios:
+                    requests.post(f'{fake_server_url}/_fake/seed', params={'records': records}).raise_for_status()
+                    env['CMC_SNAPSHOT_DATABASE_PATH'] = os.path.join(directory, f'cmc-{scenario}-{records}.sqlite3')
+                    child = subprocess.run(
+                        [sys.executable, '-m', 'benchmarks.bench_api', '--child', scenario,
+                         '--records', str(records), '--iterations', str(iterations)],
+                        env=env, stdout=subprocess.PIPE, check=True, universal_newlines=True)
+                    result = json.loads(child.stdout.strip().splitlines()[-1])
+                    stats = requests.get(f'{fake_server_url}/_fake/stats').json()
+                    result.update(scenario=scenario, records=records,
+                                  airtable_calls=stats.get('list', 0) + stats.get('patch', 0),
+                                  throttled=stats.get('throttled', 0))
+                    results.append(result)
+                    print(f"{scenario:<32} {records:>8} {result['warmup_seconds']:>8.3f}s " +
+                          f"{result['p50_seconds']:>8.3f}s {result['p99_seconds']:>8.3f}s " +
+                          f"{result['throughput']:>10.0f} {result['unit']:<9} " +
+                          f"{result['peak_rss_mb']:>6.0f} MB {result['airtable_calls']:>15}", flush=True)
+    finally:
+        server.terminate()
+        server.wait()
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the API shim against fake Airtable and CMC servers.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(SIZES))
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument('--iterations', type=int, default=5)
+    parser.add_argument('--output', help='Also write the results to this JSON file')
+    parser.add_argument('--child', choices=SCENARIOS, help=argparse.SUPPRESS)
+    parser.add_argument('--records', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child, args.records, args.iterations)
+    else:
+        run_benchmarks(args.sizes, args.scenarios, args.iterations, args.output)
@@ -0,0 +1,47 @@
+import sys
+import timeit
+from typing import List
+
+from airtable import (batch_citizen_id_expressions,
+                      build_airtable_formula_chain,
+                      build_citizen_id_matched_params, get_encoded_length)
+
+# The builder airtable.py used before variadic OR()/AND() chains, kept here as the baseline
+sys.setrecursionlimit(10000)
+
+
+def build_nested_airtable_formula_chain(formula: str, expressions: List[str]) -> str:
+    if len(expressions) == 0:
+        return ''
+    if len(expressions) == 1:
+        return expressions[0]
+    return f"{formula}({expressions[0]},{build_nested_airtable_formula_chain(formula, expressions[1:])})"
+
+
+def make_citizen_ids(count: int) -> List[str]:
+    return [f"{1100000000000 + i:013d}" for i in range(count)]
+
+
+def bench_formula_chain():
+    print('Formula chain build time per call')
+    for count in (10, 100, 1000, 5000):
+        expressions = [f'{{Citizen ID}}="{citizen_id}"' for citizen_id in make_citizen_ids(count)]
+        number = max(1, 10000 // count)
+        nested = timeit.timeit(lambda: build_nested_airtable_formula_chain('OR', expressions), number=number) / number
+        flat = timeit.timeit(lambda: build_airtable_formula_chain('OR', expressions), number=number) / number
+        print(f'  {count:>5} expressions: nested {nested * 1e6:10.1f}us, flat {flat * 1e6:8.1f}us, ' +
+              f'speedup {nested / flat:6.1f}x')
+
+
+def bench_citizen_id_batching():
+    print('Citizen ID lookup requests')
+    for count in (100, 1000, 10000):
+        batches = batch_citizen_id_expressions(make_citizen_ids(count))
+        longest_url = max(map(get_encoded_length, map(build_citizen_id_matched_params, batches)))
+        print(f'  {count:>5} citizen IDs: {-(-count // 100):>4} requests before, {len(batches):>4} requests now ' +
+              f'({longest_url} characters in the longest URL)')
+
+
+if __name__ == '__main__':
+    bench_formula_chain()
+    bench_citizen_id_batching()
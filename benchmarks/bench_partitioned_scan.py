@@ -0,0 +1,73 @@
+import argparse
+import asyncio
+import logging
+import os
+import tempfile
+import time
+
+import requests
+
+from benchmarks.bench_api import get_free_port, start_fake_servers
+
+# Compares reading a whole /requests result through serial offset pagination with partitioned scans, against
+# benchmarks/fake_servers.py answering every call after FAKE_AIRTABLE_LATENCY under the real rate limit
+SIZES = (1000, 5000, 20000)
+
+
+async def scan(partitioned: bool) -> list:
+    from airtable import get_airtable_records
+    return await get_airtable_records([('pageSize', 100)], partitioned=partitioned)
+
+
+def count_list_calls(fake_server_url: str) -> int:
+    return requests.get(f'{fake_server_url}/_fake/stats').json().get('list', 0)
+
+
+def run_benchmarks(sizes, partitions: int, latency: float):
+    port = get_free_port()
+    fake_server_url = f'http://127.0.0.1:{port}'
+    os.environ['FAKE_AIRTABLE_LATENCY'] = str(latency)
+    server = start_fake_servers(port)
+    logging.disable(logging.WARNING)
+
+    print(f"{'records':>8} {'serial':>9} {'calls':>6} {'partitioned':>12} {'calls':>6} {'speed-up':>9}")
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            os.environ.update(AIRTABLE_BASE_URL=f'{fake_server_url}/v0/base/Care%20Requests',
+                              AIRTABLE_RATE_LIMIT_FILE=os.path.join(directory, 'airtable-rate-limit'),
+                              AIRTABLE_SCAN_PARTITIONS=str(partitions))
+            from airtable import AIRTABLE_SCAN_FIELD, close_airtable_client
+
+            loop = asyncio.get_event_loop()
+            for records in sizes:
+                requests.post(f'{fake_server_url}/_fake/seed', params={'records': records}).raise_for_status()
+                results = {}
+                for partitioned in (False, True):
+                    calls = count_list_calls(fake_server_url)
+                    started_at = time.perf_counter()
+                    scanned = loop.run_until_complete(scan(partitioned))
+                    results[partitioned] = (scanned, time.perf_counter() - started_at,
+                                            count_list_calls(fake_server_url) - calls)
+
+                (serial, serial_seconds, serial_calls), (partitioned, seconds, calls) = results[False], results[True]
+                record_ids = [record['id'] for record in partitioned]
+                assert len(record_ids) == len(set(record_ids)), 'Partitioned scans must not repeat records'
+                assert set(record_ids) == {record['id'] for record in serial}, 'Both scans must read every record'
+                values = [record['fields'].get(AIRTABLE_SCAN_FIELD) or '' for record in partitioned]
+                assert values == sorted(values), f'Partitioned scans must be ordered on {AIRTABLE_SCAN_FIELD}'
+                print(f'{records:>8} {serial_seconds:>8.2f}s {serial_calls:>6} {seconds:>11.2f}s {calls:>6} ' +
+                      f'{serial_seconds / seconds:>8.1f}x', flush=True)
+            loop.run_until_complete(close_airtable_client())
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare serial and partitioned scans of the Airtable table.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(SIZES))
+    parser.add_argument('--partitions', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.4,
+                        help='Seconds the fake Airtable takes to answer each call')
+    args = parser.parse_args()
+    run_benchmarks(args.sizes, args.partitions, args.latency)
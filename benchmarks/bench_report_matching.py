@@ -0,0 +1,56 @@
+import datetime
+import time
+from typing import List
+
+from care_reports import plan_care_status_updates
+from models import CareProvidedReport
+from utils import hyphenate_citizen_id
+
+NOW = datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=7)))
+
+
+def make_reports_and_records(count: int):
+    citizen_ids = [f"{1100000000000 + i:013d}" for i in range(count)]
+    # Every 20th report is a duplicate and every 10th citizen has no matching record
+    reports = [CareProvidedReport(citizen_id=citizen_ids[i - 1 if i % 20 == 0 and i > 0 else i],
+                                  care_provider_name=f'Hospital {i % 7}') for i in range(count)]
+    records = [{'id': f'rec{i:014d}', 'fields': {'Citizen ID': hyphenate_citizen_id(citizen_id),
+                                                 'Care Status': 'PROVIDED' if i % 3 == 0 else 'SEEKING',
+                                                 'Care Provider Name': f'Hospital {i % 7}',
+                                                 'Note': 'Note'}}
+               for i, citizen_id in enumerate(citizen_ids) if i % 10 != 0]
+    return reports, records
+
+
+def plan_care_status_updates_by_scanning(care_provided_report: List[CareProvidedReport], matched_records: List):
+    # The matching loop report_provided_care used before the matches were grouped by Citizen ID
+    records_to_be_updated = []
+    for report in care_provided_report:
+        citizen_id = hyphenate_citizen_id(report.citizen_id)
+        id_matched_records = list(filter(lambda record: record.get(
+            'fields').get('Citizen ID') == citizen_id, matched_records))
+        if len(list(filter(lambda rp: rp.citizen_id == report.citizen_id, care_provided_report))) != 1:
+            continue
+        for record in id_matched_records:
+            fields = record.get('fields')
+            if not (fields.get('Care Status') == 'PROVIDED' and
+                    fields.get('Care Provider Name', '') == report.care_provider_name):
+                records_to_be_updated.append(record.get('id'))
+    return records_to_be_updated
+
+
+def measure(function, *args) -> float:
+    started_at = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - started_at
+
+
+if __name__ == '__main__':
+    print(f"{'reports':>8} {'grouped':>10} {'per report':>12} {'scanning':>10}")
+    for count in (1000, 10000, 100000):
+        reports, records = make_reports_and_records(count)
+        grouped = measure(plan_care_status_updates, reports, records, NOW)
+        # The quadratic version takes hours at 100k reports
+        scanning = f'{measure(plan_care_status_updates_by_scanning, reports, records):9.2f}s' \
+            if count <= 10000 else '        -'
+        print(f'{count:>8} {grouped:9.3f}s {grouped / count * 1e6:10.2f}us {scanning}')
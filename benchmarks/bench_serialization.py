@@ -0,0 +1,59 @@
+import argparse
+import asyncio
+import datetime
+import json
+import random
+import time
+
+from fastapi.routing import serialize_response
+from starlette.responses import JSONResponse
+
+from benchmarks.fake_servers import make_care_request_record
+from compression import Compressor
+from conversion import convert_airtable_records, dump_care_request_response
+from main import app
+
+SIZES = (10000, 50000, 100000)
+
+
+def measure(function, *args):
+    # CPU time rather than wall time, serialisation and compression never wait on anything
+    started_at = time.process_time()
+    result = function(*args)
+    return result, time.process_time() - started_at
+
+
+def serialise_with_response_model(care_requests) -> bytes:
+    # What FastAPI does with the dict read_requests used to return: validate it against CareRequestResponse,
+    # turn it into plain data with jsonable_encoder and encode that with the json module
+    route = next(route for route in app.routes if getattr(route, 'path', None) == '/requests')
+    content = asyncio.get_event_loop().run_until_complete(serialize_response(
+        field=route.secure_cloned_response_field, response_content={'data': care_requests}))
+    return JSONResponse(content).body
+
+
+def compress(encoding: str, body: bytes) -> bytes:
+    return Compressor(encoding).finish(body)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare /requests serialisation and compression costs.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(SIZES))
+    args = parser.parse_args()
+
+    print(f"{'records':>8} {'response_model':>15} {'orjson':>9} {'speed-up':>9} {'raw':>10} " +
+          f"{'gzip':>17} {'br':>17}")
+    for count in args.sizes:
+        rng = random.Random(0)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        care_requests = convert_airtable_records([make_care_request_record(i, rng, now) for i in range(count)])
+
+        validated_body, validated_seconds = measure(serialise_with_response_model, care_requests)
+        body, seconds = measure(dump_care_request_response, care_requests)
+        assert json.loads(body) == json.loads(validated_body), 'The fast path must produce the same JSON'
+
+        compressed = {encoding: measure(compress, encoding, body) for encoding in ('gzip', 'br')}
+        print(f'{count:>8} {validated_seconds:>14.3f}s {seconds:>8.3f}s {validated_seconds / seconds:>8.1f}x ' +
+              f'{len(body) / 1e6:>7.1f} MB ' +
+              ' '.join(f'{len(compressed_body) / 1e6:>5.1f} MB {compressed_seconds:>6.3f}s'
+                       for compressed_body, compressed_seconds in compressed.values()))
@@ -0,0 +1,408 @@
+import argparse
+import asyncio
+import collections
+import datetime
+import functools
+import json
+import os
+import random
+import re
+import time
+import uuid
+from typing import Callable, Dict, List, Optional
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+from utils import hyphenate_citizen_id
+
+# Stand-ins for the Airtable Care Requests table and the CMC nawaminsent feed, covering what the shim uses of them
+FAKE_AIRTABLE_LATENCY = float(os.environ.get('FAKE_AIRTABLE_LATENCY', 0))
+# Requests per second above which the fake Airtable answers 429, like the real 5 requests per second per base
+FAKE_AIRTABLE_RATE_LIMIT = float(os.environ.get('FAKE_AIRTABLE_RATE_LIMIT', 0))
+FAKE_AIRTABLE_THROTTLE_PROBABILITY = float(os.environ.get('FAKE_AIRTABLE_THROTTLE_PROBABILITY', 0))
+# Airtable itself sends no Retry-After, which makes the shim back off for 30 seconds
+FAKE_AIRTABLE_RETRY_AFTER = os.environ.get('FAKE_AIRTABLE_RETRY_AFTER')
+FAKE_CMC_LATENCY = float(os.environ.get('FAKE_CMC_LATENCY', 0))
+# Every n-th citizen has been transferred to a hospital in the CMC feed
+FAKE_CMC_TRANSFERRED_EVERY = int(os.environ.get('FAKE_CMC_TRANSFERRED_EVERY', 5))
+
+AIRTABLE_PAGE_SIZE = 100
+AIRTABLE_PATCH_BATCH_SIZE = 10
+MAX_CURSORS = 1000
+
+UTC = datetime.timezone.utc
+DATETIME_DIFF_UNITS = {
+    'ms': 0.001, 'milliseconds': 0.001, 's': 1, 'seconds': 1, 'm': 60, 'minutes': 60, 'h': 3600, 'hours': 3600,
+    'd': 86400, 'days': 86400, 'w': 604800, 'weeks': 604800,
+}
+
+TOKEN_PATTERN = re.compile(r'\s*(?:(?P<field>\{[^}]*\})|(?P<string>"(?:[^"\\]|\\.)*")|(?P<number>\d+(?:\.\d+)?)|'
+                           r'(?P<name>[A-Z_]+)|(?P<operator>>=|<=|!=|[=<>(),]))')
+
+
+class FormulaError(ValueError):
+    pass
+
+
+def tokenize_formula(formula: str) -> List[tuple]:
+    tokens = []
+    position = 0
+    formula = formula.rstrip()
+    while position < len(formula):
+        match = TOKEN_PATTERN.match(formula, position)
+        if match is None:
+            raise FormulaError(f'Unexpected character at {position}: {formula[position:position + 20]!r}')
+        tokens.append((match.lastgroup, match.group(match.lastgroup)))
+        position = match.end()
+    return tokens
+
+
+def parse_formula(formula: str):
+    # Parses the subset of the Airtable formula language the shim sends into a tuple tree
+    tokens = tokenize_formula(formula)
+    position = 0
+
+    def peek() -> Optional[tuple]:
+        return tokens[position] if position < len(tokens) else None
+
+    def take(expected: Optional[str] = None) -> tuple:
+        nonlocal position
+        token = peek()
+        if token is None or (expected is not None and token[1] != expected):
+            raise FormulaError(f'Expected {expected or "a token"}, got {token}')
+        position += 1
+        return token
+
+    def parse_operand():
+        kind, value = take()
+        if kind == 'field':
+            return ('field', value[1:-1])
+        if kind == 'string':
+            return ('literal', re.sub(r'\\(.)', r'\1', value[1:-1]))
+        if kind == 'number':
+            return ('literal', float(value))
+        if kind == 'name':
+            take('(')
+            args = []
+            if peek() != ('operator', ')'):
+                args.append(parse_expression())
+                while peek() == ('operator', ','):
+                    take(',')
+                    args.append(parse_expression())
+            take(')')
+            return ('call', value, args)
+        raise FormulaError(f'Unexpected {value!r}')
+
+    def parse_expression():
+        left = parse_operand()
+        token = peek()
+        if token is not None and token[1] in ('=', '!=', '>', '>=', '<', '<='):
+            take()
+            return ('compare', token[1], left, parse_operand())
+        return left
+
+    tree = parse_expression()
+    if position != len(tokens):
+        raise FormulaError(f'Unexpected {tokens[position][1]!r}')
+    return tree
+
+
+@functools.lru_cache(maxsize=None)
+def parse_timestamp(value: str) -> datetime.datetime:
+    return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo=UTC)
+
+
+def to_datetime(value) -> Optional[datetime.datetime]:
+    if value is None or isinstance(value, datetime.datetime):
+        return value
+    # Parsed once per timestamp, or formulas over datetime fields hold up every other call to the fake servers
+    return parse_timestamp(value)
+
+
+def compile_formula(tree) -> Callable[[dict], object]:
+    kind = tree[0]
+    if kind == 'literal':
+        value = tree[1]
+        return lambda record: value
+    if kind == 'field':
+        field = tree[1]
+        return lambda record: record['fields'].get(field)
+    if kind == 'compare':
+        operator, left, right = tree[1], compile_formula(tree[2]), compile_formula(tree[3])
+        if operator == '=':
+            return lambda record: (left(record) or '') == (right(record) or '')
+        if operator == '!=':
+            return lambda record: (left(record) or '') != (right(record) or '')
+        compare = {'>': lambda a, b: a > b, '>=': lambda a, b: a >= b,
+                   '<': lambda a, b: a < b, '<=': lambda a, b: a <= b}[operator]
+
+        def compare_values(record):
+            first, second = left(record), right(record)
+            return first is not None and second is not None and compare(first, second)
+        return compare_values
+
+    name, args = tree[1], tree[2]
+    if name == 'OR' and len(args) > 0 and all(
+            arg[0] == 'compare' and arg[1] == '=' and arg[2][0] == 'field' and arg[3][0] == 'literal' and
+            arg[2][1] == args[0][2][1] for arg in args):
+        # The long citizen ID ORs become one set lookup instead of thousands of comparisons per record
+        field, values = args[0][2][1], {arg[3][1] for arg in args}
+        return lambda record: record['fields'].get(field) in values
+    compiled_args = [compile_formula(arg) for arg in args]
+    if name == 'AND':
+        return lambda record: all(arg(record) for arg in compiled_args)
+    if name == 'OR':
+        return lambda record: any(arg(record) for arg in compiled_args)
+    if name == 'DATETIME_PARSE':
+        value = args[0][1]
+        parsed = datetime.datetime.strptime(value, '%Y %m %d %H %M %S %z')
+        return lambda record: parsed
+    if name == 'DATETIME_DIFF':
+        unit = DATETIME_DIFF_UNITS[args[2][1] if len(args) > 2 else 'seconds']
+
+        def datetime_diff(record):
+            first, second = to_datetime(compiled_args[0](record)), to_datetime(compiled_args[1](record))
+            if first is None or second is None:
+                return None
+            return int((first - second).total_seconds() / unit)
+        return datetime_diff
+    if name == 'IS_AFTER':
+        return lambda record: to_datetime(compiled_args[0](record)) > to_datetime(compiled_args[1](record))
+    if name == 'BLANK':
+        return lambda record: None
+    if name == 'LAST_MODIFIED_TIME':
+        return lambda record: record['_modified']
+    raise FormulaError(f'Unsupported function {name}')
+
+
+def format_timestamp(_datetime: datetime.datetime) -> str:
+    return _datetime.strftime('%Y-%m-%dT%H:%M:%S.') + f'{_datetime.microsecond // 1000:03d}Z'
+
+
+def make_citizen_id(i: int) -> str:
+    return f'{1100000000000 + i:013d}'
+
+
+def make_care_request_record(i: int, rng: random.Random, now: datetime.datetime) -> dict:
+    requested_at = now - datetime.timedelta(days=rng.uniform(0, 60))
+    status_changed_at = requested_at + datetime.timedelta(hours=rng.uniform(0, 72))
+    return {
+        'id': f'rec{i:014d}',
+        'createdTime': format_timestamp(requested_at),
+        'fields': {
+            'Citizen ID': hyphenate_citizen_id(make_citizen_id(i)),
+            'First Name': f'First {i}',
+            'Last Name': f'Last {i}',
+            'Phone Number': f'08{rng.randrange(10 ** 8):08d}',
+            'Email': f'citizen{i}@example.com',
+            'Sex': rng.choice(['FEMALE', 'MALE']),
+            'Date of Birth': f'{rng.randint(1940, 2005)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}',
+            'Status': rng.choice(['UNCONTACTED', 'WORKING', 'FINISHED', 'FINISHED', 'NOT_COMPATIBLE']),
+            'Street Address': f'{i} Sukhumvit Road',
+            'Subdistrict': 'Khlong Toei',
+            'District': 'Khlong Toei',
+            'Province': 'Bangkok',
+            'Postal Code': '10110',
+            'Request Datetime': format_timestamp(requested_at),
+            'Covid Test Document Image': [{'url': f'https://dl.airtable.com/attachments/{i}.jpg'}],
+            'Covid Test Location Type': rng.choice(['PUBLIC_HEALTH_CENTER', 'BMA_HOSPITAL', 'PRIVATE_HOSPITAL']),
+            'Covid Test Location Name': 'Hospital',
+            'Covid Test Date': (requested_at - datetime.timedelta(days=1)).strftime('%Y-%m-%d'),
+            'Symptoms': rng.sample(['FEVER', 'COUGH', 'HEMOPTYSIS', 'DYSPNEA', 'ORTHOPNEA'], rng.randint(0, 3)),
+            'Symptoms Level': rng.choice(['RED', 'YELLOW', 'GREEN']),
+            'Care Status': rng.choice(['NOT_SEEKING', 'SEEKING', 'SEEKING', 'PROVIDED']),
+            'Location Latitude': round(rng.uniform(13.5, 14), 6),
+            'Location Longitude': round(rng.uniform(100.3, 100.9), 6),
+            'Caretaker First Name': f'Caretaker {i}',
+            'Caretaker Last Name': f'Last {i}',
+            'Caretaker Phone Number': f'02{rng.randrange(10 ** 7):07d}',
+            'Caretaker Relationship': 'Family',
+            'Note': '',
+            'Last Status Change Datetime': format_timestamp(status_changed_at),
+            'Last Care Status Change Datetime': format_timestamp(status_changed_at),
+        },
+    }
+
+
+def make_cmc_row(i: int, revision: int = 0) -> dict:
+    return {
+        'citizen_id': make_citizen_id(i),
+        'hos_name': f'Hospital {(i + revision) % 7}',
+        'transfer_status': '1' if i % FAKE_CMC_TRANSFERRED_EVERY == 0 else '0',
+        'revision': revision,
+    }
+
+
+class FakeStore:
+    def __init__(self):
+        self.records: List[dict] = []
+        self.records_by_id: Dict[str, dict] = {}
+        self.cmc_revisions: Dict[int, int] = {}
+        self.cursors = collections.OrderedDict()
+        self.request_times = collections.deque()
+        self.stats = collections.Counter()
+
+    def seed(self, count: int, seed: int = 0):
+        rng = random.Random(seed)
+        now = datetime.datetime.now(UTC)
+        self.records = [make_care_request_record(i, rng, now) for i in range(count)]
+        modified = now - datetime.timedelta(days=1)
+        for record in self.records:
+            record['_modified'] = modified
+        self.records_by_id = {record['id']: record for record in self.records}
+        self.cmc_revisions = {}
+        self.cursors.clear()
+        self.stats.clear()
+
+    def is_throttled(self) -> bool:
+        now = time.monotonic()
+        self.request_times.append(now)
+        while self.request_times[0] < now - 1:
+            self.request_times.popleft()
+        return (FAKE_AIRTABLE_RATE_LIMIT > 0 and len(self.request_times) > FAKE_AIRTABLE_RATE_LIMIT) or \
+            random.random() < FAKE_AIRTABLE_THROTTLE_PROBABILITY
+
+
+store = FakeStore()
+
+
+def strip_record(record: dict, fields: Optional[List[str]] = None) -> dict:
+    return {
+        'id': record['id'],
+        'createdTime': record['createdTime'],
+        'fields': record['fields'] if not fields else
+        {field: record['fields'][field] for field in fields if field in record['fields']},
+    }
+
+
+def get_page(cursor: dict) -> dict:
+    records = cursor['records'][cursor['position']:cursor['position'] + cursor['page_size']]
+    cursor['position'] += len(records)
+    content = {'records': [strip_record(record, cursor['fields']) for record in records]}
+    if cursor['position'] < len(cursor['records']):
+        offset = str(uuid.uuid4())
+        store.cursors[offset] = cursor
+        while len(store.cursors) > MAX_CURSORS:
+            store.cursors.popitem(last=False)
+        content['offset'] = offset
+    return content
+
+
+def throttled_response() -> JSONResponse:
+    store.stats['throttled'] += 1
+    headers = {'Retry-After': FAKE_AIRTABLE_RETRY_AFTER} if FAKE_AIRTABLE_RETRY_AFTER else None
+    return JSONResponse({'errors': [{'error': 'RATE_LIMIT_REACHED'}]}, status_code=429, headers=headers)
+
+
+async def list_records(request: Request):
+    await asyncio.sleep(FAKE_AIRTABLE_LATENCY)
+    if store.is_throttled():
+        return throttled_response()
+    store.stats['list'] += 1
+    params = request.query_params
+
+    if 'offset' in params:
+        cursor = store.cursors.pop(params['offset'], None)
+        if cursor is None:
+            return JSONResponse({'error': {'type': 'LIST_RECORDS_ITERATOR_NOT_AVAILABLE'}}, status_code=422)
+        return JSONResponse(get_page(cursor))
+
+    records = store.records
+    if params.get('filterByFormula'):
+        try:
+            matches = compile_formula(parse_formula(params['filterByFormula']))
+        except (FormulaError, KeyError, IndexError, ValueError) as e:
+            return JSONResponse({'error': {'type': 'INVALID_FILTER_BY_FORMULA', 'message': str(e)}},
+                                status_code=422)
+        records = [record for record in records if matches(record)]
+    if params.get('sort[0][field]'):
+        field = params['sort[0][field]']
+        records = sorted(records, key=lambda record: record['fields'].get(field) or '',
+                         reverse=params.get('sort[0][direction]') == 'desc')
+
+    return JSONResponse(get_page({
+        'records': records,
+        'position': 0,
+        'page_size': min(int(params.get('pageSize', AIRTABLE_PAGE_SIZE)), AIRTABLE_PAGE_SIZE),
+        'fields': params.getlist('fields[]'),
+    }))
+
+
+async def update_records(request: Request):
+    await asyncio.sleep(FAKE_AIRTABLE_LATENCY)
+    if store.is_throttled():
+        return throttled_response()
+    store.stats['patch'] += 1
+    updates = (await request.json()).get('records', [])
+    if len(updates) > AIRTABLE_PATCH_BATCH_SIZE:
+        return JSONResponse({'error': {'type': 'INVALID_RECORDS'}}, status_code=422)
+    if any(update.get('id') not in store.records_by_id for update in updates):
+        return JSONResponse({'error': {'type': 'ROW_DOES_NOT_EXIST'}}, status_code=422)
+
+    modified = datetime.datetime.now(UTC)
+    records = []
+    for update in updates:
+        record = store.records_by_id[update['id']]
+        record['fields'].update(update.get('fields', {}))
+        record['_modified'] = modified
+        records.append(strip_record(record))
+    store.stats['patched_records'] += len(records)
+    return JSONResponse({'records': records})
+
+
+async def list_cmc_rows(request: Request):
+    await asyncio.sleep(FAKE_CMC_LATENCY)
+    store.stats['cmc'] += 1
+
+    def iter_body():
+        yield '['
+        for i in range(len(store.records)):
+            yield (',' if i > 0 else '') + json.dumps(make_cmc_row(i, store.cmc_revisions.get(i, 0)),
+                                                      ensure_ascii=False)
+        yield ']'
+
+    return StreamingResponse(iter_body(), media_type='application/json')
+
+
+async def seed(request: Request):
+    store.seed(int(request.query_params.get('records', 1000)), int(request.query_params.get('seed', 0)))
+    return JSONResponse({'records': len(store.records)})
+
+
+async def touch_cmc_rows(request: Request):
+    # Changes the hospital of a random sample of CMC rows, to exercise the poller's change detection
+    rng = random.Random(int(request.query_params.get('seed', 0)))
+    count = int(len(store.records) * float(request.query_params.get('fraction', 0.01)))
+    for i in rng.sample(range(len(store.records)), count):
+        store.cmc_revisions[i] = store.cmc_revisions.get(i, 0) + 1
+    return JSONResponse({'touched': count})
+
+
+async def get_stats(request: Request):
+    return JSONResponse(dict(store.stats))
+
+
+app = Starlette(routes=[
+    Route('/v0/{base_id}/{table_name}', list_records, methods=['GET']),
+    Route('/v0/{base_id}/{table_name}', update_records, methods=['PATCH']),
+    Route('/cmc', list_cmc_rows, methods=['GET']),
+    Route('/_fake/seed', seed, methods=['POST']),
+    Route('/_fake/cmc/touch', touch_cmc_rows, methods=['POST']),
+    Route('/_fake/stats', get_stats, methods=['GET']),
+])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve fake Airtable and CMC APIs for local benchmarks.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--records', type=int, default=1000)
+    args = parser.parse_args()
+    store.seed(args.records)
+    print(f'Airtable: AIRTABLE_BASE_URL=http://{args.host}:{args.port}/v0/base/Care%20Requests')
+    print(f'CMC: CMC_API_BASE_URL=http://{args.host}:{args.port}/cmc')
+    uvicorn.run(app, host=args.host, port=args.port, log_level='warning')
@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable, Optional, Tuple
+
+import dotenv
+
+from metrics import cache_requests_total
+
+dotenv.load_dotenv()
+
+# Setting REQUESTS_CACHE_TTL to 0 disables the /requests response cache
+REQUESTS_CACHE_TTL = float(os.environ.get('REQUESTS_CACHE_TTL', 30))
+REQUESTS_CACHE_MAX_ENTRIES = int(os.environ.get('REQUESTS_CACHE_MAX_ENTRIES', 128))
+REQUESTS_CACHE_STALE_TTL = float(os.environ.get('REQUESTS_CACHE_STALE_TTL', 3600))
+# Clearing the cache touches this file, every worker on the host drops its entries once it sees the new mtime
+REQUESTS_CACHE_INVALIDATION_FILE = os.environ.get('REQUESTS_CACHE_INVALIDATION_FILE', os.path.join(
+    tempfile.gettempdir(), f"requests-cache-invalidated-{os.environ.get('AIRTABLE_BASE_ID')}"))
+
+
+class TTLCache:
+    HIT = 'HIT'
+    MISS = 'MISS'
+    COALESCED = 'COALESCED'
+    STALE = 'STALE'
+
+    def __init__(self, name: str, ttl: float, max_entries: int, stale_ttl: float,
+                 invalidation_path: Optional[str] = None):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # Expired entries are kept (within max_entries) for up to stale_ttl to be served when the upstream fails
+        self.stale_ttl = stale_ttl
+        self.invalidation_path = invalidation_path
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._invalidated_at = self._read_invalidated_at()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.stale_hits = 0
+
+    def _read_invalidated_at(self) -> int:
+        if self.invalidation_path is None:
+            return 0
+        try:
+            return os.stat(self.invalidation_path).st_mtime_ns
+        except FileNotFoundError:
+            return 0
+
+    def _drop_invalidated_entries(self):
+        invalidated_at = self._read_invalidated_at()
+        if invalidated_at != self._invalidated_at:
+            self._entries.clear()
+            self._invalidated_at = invalidated_at
+
+    def clear(self):
+        self._entries.clear()
+        if self.invalidation_path is not None:
+            with open(self.invalidation_path, 'a'):
+                pass
+            os.utime(self.invalidation_path)
+        self._invalidated_at = self._read_invalidated_at()
+
+    def _store(self, key: Hashable, value: Any):
+        self._entries[key] = (value, time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def _fetch(self, key: Hashable, fetch: Callable[[], Awaitable[Any]], invalidated_at: int) -> Any:
+        value = await fetch()
+        self._drop_invalidated_entries()
+        # A fetch that started before the cache was cleared may not have seen the change that cleared it
+        if self._invalidated_at == invalidated_at:
+            self._store(key, value)
+        return value
+
+    def _start_fetch(self, key: Hashable, fetch: Callable[[], Awaitable[Any]], refresh: bool = False) -> asyncio.Future:
+        task = asyncio.ensure_future(self._fetch(key, fetch, self._invalidated_at))
+        self._in_flight[key] = (task, self._invalidated_at, refresh)
+
+        def finish(task: asyncio.Future):
+            if self._in_flight.get(key, (None,))[0] is task:
+                del self._in_flight[key]
+            # Retrieve the exception even if every waiter went away, so it is not reported as unhandled
+            task.cancelled() or task.exception()
+
+        task.add_done_callback(finish)
+        return task
+
+    def _serve_stale(self, entry: Tuple[Any, float], reason: str) -> Tuple[Any, str]:
+        self.stale_hits += 1
+        cache_requests_total.inc(cache=self.name, result=self.STALE)
+        logging.warn(f'{self.name} cache is serving stale data {reason}')
+        return entry[0], self.STALE
+
+    async def get_or_fetch(self, key: Hashable, fetch: Callable[[], Awaitable[Any]],
+                           fetch_fast: Optional[Callable[[], Awaitable[Any]]] = None) -> Tuple[Any, str]:
+        self._drop_invalidated_entries()
+        entry = self._entries.get(key)
+        if entry is not None and time.monotonic() - entry[1] < self.ttl:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            cache_requests_total.inc(cache=self.name, result=self.HIT)
+            return entry[0], self.HIT
+
+        # With a stale entry to fall back on, fetch_fast (which fails rather than waits, e.g. on a rate limit) is
+        # tried first. When it fails, the stale entry is served at once and fetch refreshes it in the background.
+        has_stale = entry is not None and time.monotonic() - entry[1] < self.stale_ttl
+
+        # Identical concurrent requests share the upstream fetch of whichever request arrived first
+        task, invalidated_at, refresh = self._in_flight.get(key, (None, None, False))
+        if task is None or invalidated_at != self._invalidated_at:
+            self.misses += 1
+            state = self.MISS
+            task = self._start_fetch(key, fetch_fast if has_stale and fetch_fast is not None else fetch)
+            logging.info(f'{self.name} cache miss (hits={self.hits}, misses={self.misses}, ' +
+                         f'coalesced={self.coalesced}, stale={self.stale_hits}).')
+        elif refresh and has_stale:
+            return self._serve_stale(entry, 'while it is refreshed in the background.')
+        else:
+            self.coalesced += 1
+            state = self.COALESCED
+
+        cache_requests_total.inc(cache=self.name, result=state)
+        try:
+            return await asyncio.shield(task), state
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if entry is None or time.monotonic() - entry[1] >= self.stale_ttl:
+                raise
+            if fetch_fast is not None and key not in self._in_flight:
+                self._start_fetch(key, fetch, refresh=True)
+            return self._serve_stale(entry, f'after an upstream error: {e!r}')
+
+
+requests_cache = TTLCache('Requests', REQUESTS_CACHE_TTL, REQUESTS_CACHE_MAX_ENTRIES, REQUESTS_CACHE_STALE_TTL,
+                          REQUESTS_CACHE_INVALIDATION_FILE)
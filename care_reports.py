@@ -0,0 +1,143 @@
+import datetime
+import logging
+from collections import Counter, defaultdict
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from starlette import status
+from starlette.concurrency import run_in_threadpool
+
+from airtable import (get_citizen_id_matched_airtable_records,
+                      patch_airtable_records_in_batches)
+from cache import requests_cache
+from citizen_index import (index_records, index_search_results,
+                           invalidate_citizen_index, is_citizen_index_enabled,
+                           lookup_citizen_index)
+from conversion import TIMEZONE
+from models import CareProvidedReport
+from replica import (is_replica_enabled, is_replica_fresh,
+                     query_replica_citizen_id_matched_records,
+                     upsert_replica_records)
+from utils import hyphenate_citizen_id
+
+
+class CareStatusUpdatePlan(NamedTuple):
+    records_to_be_updated: List[dict]
+    reports_by_record_id: Dict[str, CareProvidedReport]
+    skipped_reports: List[CareProvidedReport]
+    updated_reports: List[CareProvidedReport]
+
+
+def plan_care_status_updates(care_provided_report: List[CareProvidedReport], matched_records: List,
+                             now: datetime.datetime,
+                             reported_at: Optional[Dict[str, datetime.datetime]] = None) -> CareStatusUpdatePlan:
+    report_counts = Counter(report.citizen_id for report in care_provided_report)
+    records_by_citizen_id = defaultdict(list)
+    for record in matched_records:
+        records_by_citizen_id[record.get('fields').get('Citizen ID')].append(record)
+
+    plan = CareStatusUpdatePlan([], {}, [], [])
+
+    for report in care_provided_report:
+        care_provider_name = report.care_provider_name
+        id_matched_records = records_by_citizen_id.get(hyphenate_citizen_id(report.citizen_id), [])
+
+        if report_counts[report.citizen_id] != 1:
+            plan.skipped_reports.append(report)
+            continue
+        if len(id_matched_records) == 1:
+            plan.updated_reports.append(report)
+        else:
+            plan.skipped_reports.append(report)
+
+        for record in id_matched_records:
+            fields = record.get('fields')
+            # Skip updating record with no changes
+            if not (fields.get('Care Status') == 'PROVIDED' and
+                    fields.get('Care Provider Name', '') == care_provider_name):
+                # Queued reports carry the time they were received, so replaying one after a crash produces the
+                # same audit line, which is then not added twice
+                audit_line = (f"Updated care status to PROVIDED by {care_provider_name} via API-SHIM on " +
+                              f"{(reported_at or {}).get(report.citizen_id, now).isoformat()}")
+                note = fields.get('Note', '')
+                plan.reports_by_record_id[record.get('id')] = report
+                plan.records_to_be_updated.append({
+                    'id': record.get('id'),
+                    'fields': {
+                        'Care Status': 'PROVIDED',
+                        'Care Provider Name': (care_provider_name if care_provider_name
+                                               else fields.get('Care Provider Name', '')),
+                        'Note': note if audit_line in note else f'{note}\n\n{audit_line}',
+                    }
+                })
+
+    return plan
+
+
+async def find_citizen_id_matched_records(citizen_ids: List[str]) -> List:
+    if is_replica_fresh():
+        return await run_in_threadpool(query_replica_citizen_id_matched_records, citizen_ids)
+    if not is_citizen_index_enabled():
+        return await get_citizen_id_matched_airtable_records(citizen_ids)
+
+    matched_records, unknown_citizen_ids = lookup_citizen_index(citizen_ids)
+    if len(unknown_citizen_ids) > 0:
+        searched_records = await get_citizen_id_matched_airtable_records(unknown_citizen_ids)
+        index_search_results(unknown_citizen_ids, searched_records)
+        matched_records += searched_records
+    return matched_records
+
+
+async def process_care_provided_report(
+        care_provided_report: List[CareProvidedReport],
+        on_progress: Optional[Callable[[int, int, int], None]] = None,
+        reported_at: Optional[Dict[str, datetime.datetime]] = None,
+        read_from_airtable: bool = False) -> Tuple[dict, int]:
+    citizen_ids = [report.citizen_id for report in care_provided_report]
+    if read_from_airtable:
+        matched_records = await get_citizen_id_matched_airtable_records(citizen_ids)
+    else:
+        matched_records = await find_citizen_id_matched_records(citizen_ids)
+
+    plan = plan_care_status_updates(care_provided_report, matched_records,
+                                    datetime.datetime.now().astimezone(TIMEZONE), reported_at)
+
+    progress = Counter()
+
+    def report_progress(written: List, failed: List):
+        progress['written'] += len(written)
+        progress['failed'] += len(failed)
+        on_progress(len(plan.records_to_be_updated), progress['written'], progress['failed'])
+
+    if on_progress is not None:
+        on_progress(len(plan.records_to_be_updated), 0, 0)
+
+    written_records, failed_records = await patch_airtable_records_in_batches(
+        plan.records_to_be_updated, report_progress if on_progress is not None else None)
+
+    logging.info(f'{len(written_records)} records updated on Airtable, {len(failed_records)} records failed.')
+
+    if len(written_records) > 0:
+        requests_cache.clear()
+        if is_replica_enabled():
+            upsert_replica_records(written_records)
+        if is_citizen_index_enabled():
+            index_records(written_records)
+
+    failed_reports = list({id(report): report for report in (
+        plan.reports_by_record_id[record['id']] for record in failed_records)}.values())
+    failed_report_ids = set(map(id, failed_reports))
+
+    if len(failed_reports) > 0 and is_citizen_index_enabled():
+        invalidate_citizen_index([report.citizen_id for report in failed_reports])
+
+    content = {
+        'skipped': [report.dict() for report in plan.skipped_reports if id(report) not in failed_report_ids],
+        'updated': [report.dict() for report in plan.updated_reports if id(report) not in failed_report_ids],
+        'failed': [report.dict() for report in failed_reports],
+    }
+
+    if len(failed_reports) > 0 and len(written_records) == 0:
+        return content, status.HTTP_503_SERVICE_UNAVAILABLE
+
+    return content, (status.HTTP_200_OK if len(plan.skipped_reports) == 0 and len(failed_reports) == 0
+                     else status.HTTP_207_MULTI_STATUS)
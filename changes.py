@@ -0,0 +1,195 @@
+import asyncio
+import datetime
+import fcntl
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import time
+from typing import List, Optional, Tuple
+
+import dotenv
+
+from airtable import (build_airtable_modified_since_formula,
+                      get_airtable_records)
+from utils import (DATA_DIRECTORY, UTC, build_in_clause, connect_sqlite,
+                   iter_chunks)
+
+dotenv.load_dotenv()
+
+CHANGES_DATABASE_PATH = os.environ.get('CHANGES_DATABASE_PATH', os.path.join(DATA_DIRECTORY, 'changes.sqlite3'))
+# Only the worker holding this lock scans Airtable for changes, every worker serves its subscribers from the log
+CHANGES_LOCK_FILE = os.environ.get('CHANGES_LOCK_FILE', os.path.join(tempfile.gettempdir(),
+                                                                     'care-request-changes.lock'))
+# Setting CHANGES_SCAN_INTERVAL to 0 stops this host from scanning for changes
+CHANGES_SCAN_INTERVAL = float(os.environ.get('CHANGES_SCAN_INTERVAL', 15))
+CHANGES_WATCH_INTERVAL = float(os.environ.get('CHANGES_WATCH_INTERVAL', 1))
+# Cursors older than this can no longer be resumed and get a 410
+CHANGES_RETENTION = int(os.environ.get('CHANGES_RETENTION', 7 * 24 * 3600))
+CHANGES_PAGE_SIZE = int(os.environ.get('CHANGES_PAGE_SIZE', 1000))
+CHANGES_MAX_WAIT = 120
+CHANGES_HEARTBEAT_INTERVAL = 15
+# Re-read records modified slightly before the last scan to cover clock skew between us and Airtable
+CHANGES_SCAN_OVERLAP = 60
+
+_changes_connection: Optional[sqlite3.Connection] = None
+_changes_available: Optional[asyncio.Event] = None
+_detector_lock: Optional[int] = None
+
+
+def get_changes_connection() -> sqlite3.Connection:
+    global _changes_connection
+    if _changes_connection is None:
+        _changes_connection = connect_sqlite(CHANGES_DATABASE_PATH, '''
+            CREATE TABLE IF NOT EXISTS care_request_states (
+                id TEXT PRIMARY KEY,
+                status TEXT,
+                care_status TEXT
+            );
+            CREATE TABLE IF NOT EXISTS changes (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                record_id TEXT NOT NULL,
+                status TEXT,
+                care_status TEXT,
+                changed_at REAL NOT NULL,
+                record TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS changes_changed_at ON changes (changed_at);
+            CREATE TABLE IF NOT EXISTS scan_state (
+                key TEXT PRIMARY KEY,
+                value REAL
+            );
+        ''')
+    return _changes_connection
+
+
+def get_changes_available() -> asyncio.Event:
+    global _changes_available
+    if _changes_available is None:
+        _changes_available = asyncio.Event()
+    return _changes_available
+
+
+def get_scan_state(key: str) -> Optional[float]:
+    row = get_changes_connection().execute('SELECT value FROM scan_state WHERE key = ?', (key,)).fetchone()
+    return row['value'] if row else None
+
+
+def get_changes_head() -> int:
+    row = get_changes_connection().execute("SELECT seq FROM sqlite_sequence WHERE name = 'changes'").fetchone()
+    return row['seq'] if row else 0
+
+
+def is_cursor_expired(cursor: int) -> bool:
+    return cursor < (get_scan_state('pruned_seq') or 0)
+
+
+def record_care_request_changes(records: List, scanned_at: float, baseline: bool = False) -> int:
+    # A change is a record whose Status or Care Status differs from the last one seen, records never seen before
+    # included. The first scan only learns the current states.
+    connection = get_changes_connection()
+    ids = [record['id'] for record in records]
+    states = {}
+    for chunk in iter_chunks(ids):
+        condition, args = build_in_clause('id', chunk)
+        for row in connection.execute(f'SELECT * FROM care_request_states WHERE {condition}', args):
+            states[row['id']] = (row['status'], row['care_status'])
+
+    changed_records = [record for record in records if states.get(record['id']) != (
+        record['fields'].get('Status'), record['fields'].get('Care Status'))]
+
+    with connection:
+        connection.executemany('INSERT OR REPLACE INTO care_request_states VALUES (?, ?, ?)', [
+            (record['id'], record['fields'].get('Status'), record['fields'].get('Care Status'))
+            for record in changed_records])
+        if not baseline:
+            connection.executemany(
+                'INSERT INTO changes (record_id, status, care_status, changed_at, record) VALUES (?, ?, ?, ?, ?)', [
+                    (record['id'], record['fields'].get('Status'), record['fields'].get('Care Status'), scanned_at,
+                     json.dumps(record)) for record in changed_records])
+        row = connection.execute('SELECT MAX(seq) AS seq FROM changes WHERE changed_at < ?',
+                                 (scanned_at - CHANGES_RETENTION,)).fetchone()
+        if row['seq'] is not None:
+            connection.execute('DELETE FROM changes WHERE seq <= ?', (row['seq'],))
+            connection.execute('INSERT OR REPLACE INTO scan_state VALUES (?, ?)', ('pruned_seq', row['seq']))
+        connection.execute('INSERT OR REPLACE INTO scan_state VALUES (?, ?)', ('scanned_at', scanned_at))
+
+    return 0 if baseline else len(changed_records)
+
+
+async def scan_care_request_changes() -> int:
+    started_at = time.time()
+    scanned_at = get_scan_state('scanned_at')
+
+    params = {'pageSize': 100}
+    if scanned_at is not None:
+        params['filterByFormula'] = build_airtable_modified_since_formula(
+            datetime.datetime.fromtimestamp(scanned_at - CHANGES_SCAN_OVERLAP, UTC))
+
+    records = await get_airtable_records(params)
+    changed = record_care_request_changes(records, started_at, baseline=scanned_at is None)
+    logging.info(f'Scanned {len(records)} records for care request changes and found {changed} ' +
+                 f'in {time.time() - started_at:.1f}s.')
+    return changed
+
+
+def get_care_request_changes(cursor: int, limit: int = CHANGES_PAGE_SIZE) -> List[Tuple[int, dict]]:
+    return [(row['seq'], json.loads(row['record'])) for row in get_changes_connection().execute(
+        'SELECT seq, record FROM changes WHERE seq > ? ORDER BY seq LIMIT ?', (cursor, limit))]
+
+
+async def wait_for_care_request_changes(cursor: int, timeout: float) -> List[Tuple[int, dict]]:
+    deadline = time.monotonic() + timeout
+    while True:
+        # Taken before reading the log, so that changes recorded in between still wake this waiter
+        changes_available = get_changes_available()
+        changes = get_care_request_changes(cursor)
+        remaining = deadline - time.monotonic()
+        if len(changes) > 0 or remaining <= 0:
+            return changes
+        try:
+            await asyncio.wait_for(changes_available.wait(), remaining)
+        except asyncio.TimeoutError:
+            pass
+
+
+def try_acquire_detector_lock() -> bool:
+    global _detector_lock
+    if _detector_lock is None:
+        fd = os.open(CHANGES_LOCK_FILE, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        # Held until the process exits, another worker takes over then
+        _detector_lock = fd
+    return True
+
+
+async def run_change_detector():
+    while CHANGES_SCAN_INTERVAL > 0:
+        try:
+            if try_acquire_detector_lock():
+                await scan_care_request_changes()
+        except Exception as e:
+            logging.error('Unable to scan for care request changes', exc_info=e)
+        await asyncio.sleep(CHANGES_SCAN_INTERVAL)
+
+
+async def watch_care_request_changes():
+    global _changes_available
+    head = None
+    while True:
+        try:
+            latest_head = get_changes_head()
+            if head is not None and latest_head != head:
+                # Waiters hold on to the current event, the next ones get a fresh one
+                changes_available = get_changes_available()
+                _changes_available = asyncio.Event()
+                changes_available.set()
+            head = latest_head
+        except Exception as e:
+            logging.error('Unable to read the care request change log', exc_info=e)
+        await asyncio.sleep(CHANGES_WATCH_INTERVAL)
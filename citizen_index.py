@@ -0,0 +1,111 @@
+import os
+import sqlite3
+import time
+from typing import List, Optional, Tuple
+
+import dotenv
+
+from utils import (build_in_clause, connect_sqlite, hyphenate_citizen_id,
+                   iter_chunks)
+
+dotenv.load_dotenv()
+
+# Setting CITIZEN_INDEX_DATABASE_PATH enables the index
+CITIZEN_INDEX_DATABASE_PATH = os.environ.get('CITIZEN_INDEX_DATABASE_PATH')
+# Index entries are trusted for this long after Airtable last confirmed them, to bound drift from edits made
+# directly in Airtable
+CITIZEN_INDEX_TTL = int(os.environ.get('CITIZEN_INDEX_TTL', 900))
+
+INDEXED_FIELDS = ('Citizen ID', 'Care Status', 'Care Provider Name', 'Request Datetime', 'Note')
+
+_citizen_index_connection: Optional[sqlite3.Connection] = None
+
+
+def is_citizen_index_enabled() -> bool:
+    return bool(CITIZEN_INDEX_DATABASE_PATH)
+
+
+def get_citizen_index_connection() -> sqlite3.Connection:
+    global _citizen_index_connection
+    if _citizen_index_connection is None:
+        _citizen_index_connection = connect_sqlite(CITIZEN_INDEX_DATABASE_PATH, '''
+            -- A row here means every record the citizen ID search would match is in records
+            CREATE TABLE IF NOT EXISTS citizens (
+                citizen_id TEXT PRIMARY KEY,
+                indexed_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS records (
+                id TEXT PRIMARY KEY,
+                citizen_id TEXT NOT NULL,
+                care_status TEXT,
+                care_provider_name TEXT,
+                request_datetime TEXT,
+                note TEXT
+            );
+            CREATE INDEX IF NOT EXISTS records_citizen_id ON records (citizen_id);
+        ''')
+    return _citizen_index_connection
+
+
+def lookup_citizen_index(citizen_ids: List[str]) -> Tuple[List, List[str]]:
+    connection = get_citizen_index_connection()
+    hyphenated_citizen_ids = {hyphenate_citizen_id(citizen_id): citizen_id for citizen_id in citizen_ids}
+    known_citizen_ids = set()
+    matched_records = []
+
+    for chunk in iter_chunks(list(hyphenated_citizen_ids)):
+        condition, args = build_in_clause('citizen_id', chunk)
+        known_citizen_ids.update(row['citizen_id'] for row in connection.execute(
+            f'SELECT citizen_id FROM citizens WHERE {condition} AND indexed_at > ?',
+            args + [time.time() - CITIZEN_INDEX_TTL]))
+
+    for chunk in iter_chunks(list(known_citizen_ids)):
+        condition, args = build_in_clause('citizen_id', chunk)
+        matched_records += [{
+            'id': row['id'],
+            'fields': {field: value for field, value in zip(INDEXED_FIELDS, (
+                row['citizen_id'], row['care_status'], row['care_provider_name'], row['request_datetime'],
+                row['note'])) if value is not None}
+        } for row in connection.execute(
+            f'SELECT * FROM records WHERE {condition}', args)]
+
+    unknown_citizen_ids = [citizen_id for hyphenated_citizen_id, citizen_id in hyphenated_citizen_ids.items()
+                           if hyphenated_citizen_id not in known_citizen_ids]
+    return sorted(matched_records, key=lambda record: record['fields'].get('Request Datetime', '')), \
+        unknown_citizen_ids
+
+
+def _upsert_records(connection: sqlite3.Connection, records: List):
+    connection.executemany('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?)', [
+        (record['id'], *(record['fields'].get(field) for field in INDEXED_FIELDS)) for record in records])
+
+
+def index_search_results(citizen_ids: List[str], records: List):
+    connection = get_citizen_index_connection()
+    hyphenated_citizen_ids = list(set(map(hyphenate_citizen_id, citizen_ids)))
+    indexed_at = time.time()
+    with connection:
+        for chunk in iter_chunks(hyphenated_citizen_ids):
+            condition, args = build_in_clause('citizen_id', chunk)
+            connection.execute(f'DELETE FROM records WHERE {condition}', args)
+        _upsert_records(connection, records)
+        connection.executemany('INSERT OR REPLACE INTO citizens VALUES (?, ?)',
+                               [(citizen_id, indexed_at) for citizen_id in hyphenated_citizen_ids])
+
+
+def index_records(records: List):
+    # Full records seen on ordinary reads and PATCH responses keep known citizens' entries current: FINISHED
+    # records are the ones the citizen ID search matches, any other status drops the record from the index
+    connection = get_citizen_index_connection()
+    records = [record for record in records if record.get('fields', {}).get('Citizen ID')]
+    with connection:
+        _upsert_records(connection, [record for record in records if record['fields'].get('Status') == 'FINISHED'])
+        connection.executemany('DELETE FROM records WHERE id = ?', [
+            (record['id'],) for record in records if record['fields'].get('Status') != 'FINISHED'])
+
+
+def invalidate_citizen_index(citizen_ids: List[str]):
+    connection = get_citizen_index_connection()
+    with connection:
+        connection.executemany('DELETE FROM citizens WHERE citizen_id = ?',
+                               [(hyphenate_citizen_id(citizen_id),) for citizen_id in citizen_ids])
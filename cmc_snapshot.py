@@ -0,0 +1,62 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from typing import Dict, List, Optional, Tuple
+
+import dotenv
+
+from utils import DATA_DIRECTORY, build_in_clause, connect_sqlite, iter_chunks
+
+dotenv.load_dotenv()
+
+# The SQLite file that remembers which CMC rows the poller has already handled
+CMC_SNAPSHOT_DATABASE_PATH = os.environ.get('CMC_SNAPSHOT_DATABASE_PATH',
+                                            os.path.join(DATA_DIRECTORY, 'cmc_snapshot.sqlite3'))
+
+_cmc_snapshot_connection: Optional[sqlite3.Connection] = None
+
+
+def get_cmc_snapshot_connection() -> sqlite3.Connection:
+    global _cmc_snapshot_connection
+    if _cmc_snapshot_connection is None:
+        _cmc_snapshot_connection = connect_sqlite(CMC_SNAPSHOT_DATABASE_PATH, '''
+            -- The hash of the CMC row last handled for each citizen, and whether it is to be forwarded again
+            CREATE TABLE IF NOT EXISTS cmc_rows (
+                citizen_id TEXT PRIMARY KEY,
+                row_hash TEXT NOT NULL,
+                retry INTEGER NOT NULL,
+                updated_at REAL NOT NULL
+            );
+        ''')
+        # Snapshots written before rows could be marked for retry lack the column
+        columns = [column[1] for column in _cmc_snapshot_connection.execute('PRAGMA table_info(cmc_rows)')]
+        if 'retry' not in columns:
+            with _cmc_snapshot_connection:
+                _cmc_snapshot_connection.execute('ALTER TABLE cmc_rows ADD COLUMN retry INTEGER NOT NULL DEFAULT 0')
+    return _cmc_snapshot_connection
+
+
+def hash_cmc_row(row: dict) -> str:
+    return hashlib.sha1(json.dumps(row, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+
+def get_cmc_row_hashes(citizen_ids: List[str]) -> Dict[str, Tuple[str, bool]]:
+    connection = get_cmc_snapshot_connection()
+    row_hashes = {}
+    for chunk in iter_chunks(citizen_ids):
+        condition, args = build_in_clause('citizen_id', chunk)
+        row_hashes.update((citizen_id, (row_hash, bool(retry))) for citizen_id, row_hash, retry in connection.execute(
+            f'SELECT citizen_id, row_hash, retry FROM cmc_rows WHERE {condition}', args))
+    return row_hashes
+
+
+def save_cmc_row_hashes(row_hashes: List[Tuple[str, str, bool]]):
+    connection = get_cmc_snapshot_connection()
+    updated_at = time.time()
+    with connection:
+        # Columns are named since migrated snapshots have retry last
+        connection.executemany(
+            'INSERT OR REPLACE INTO cmc_rows (citizen_id, row_hash, retry, updated_at) VALUES (?, ?, ?, ?)',
+            [(citizen_id, row_hash, retry, updated_at) for citizen_id, row_hash, retry in row_hashes])
@@ -0,0 +1,343 @@
+import datetime
+import decimal
+import logging
+import os
+import re
+from collections import Counter
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple, Type
+
+import orjson
+import phonenumbers
+from backports.datetime_fromisoformat import MonkeyPatch
+from pydantic import BaseModel, EmailStr, ValidationError
+from pydantic.datetime_parse import parse_date
+
+from metrics import dropped_records_total
+from models import (CareRequest, CareStatus, Channel, CovidTestLocationType,
+                    RequestStatus, Sex, Symptom, SymptomsLevel)
+
+MonkeyPatch.patch_fromisoformat()
+
+TIMEZONE = datetime.timezone(datetime.timedelta(hours=7))
+
+CHANNEL_NAME = 'BKKCOVID19CONNECT'
+
+# Strict mode builds every record through full pydantic validation instead of the checks below
+CONVERSION_STRICT_VALIDATION = os.environ.get('CONVERSION_STRICT_VALIDATION', '').lower() in ('1', 'true')
+
+TIMESTAMP_FIELDS = ('Request Datetime', 'Last Care Status Change Datetime', 'Last Status Change Datetime')
+# The column projected responses ask Airtable for when they need none
+PROJECTION_PLACEHOLDER_FIELD = 'Citizen ID'
+
+CITIZEN_ID_PATTERN = re.compile(r'^\d{13}$')
+POSTAL_CODE_PATTERN = re.compile(r'^\d{5}$')
+# Matches pydantic's HttpUrl maximum length
+MAX_URL_LENGTH = 2083
+
+
+class ConversionError(ValueError):
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+@lru_cache(maxsize=65536)
+def normalise_phone_number(phone_number: str) -> str:
+    return phonenumbers.format_number(phonenumbers.parse(phone_number, "TH"), phonenumbers.PhoneNumberFormat.E164)
+
+
+@lru_cache(maxsize=65536)
+def normalise_email(email: str) -> str:
+    return EmailStr.validate(email)
+
+
+@lru_cache(maxsize=65536)
+def normalise_date(date: str) -> datetime.date:
+    return parse_date(date)
+
+
+def parse_airtable_timestamps(records: List) -> Dict[str, datetime.datetime]:
+    timestamps = set()
+    for record in records:
+        fields = record.get('fields', {})
+        for field in TIMESTAMP_FIELDS:
+            if fields.get(field):
+                timestamps.add(fields[field])
+    parsed_timestamps = {}
+    for timestamp in timestamps:
+        try:
+            parsed_timestamps[timestamp] = datetime.datetime.fromisoformat(
+                f"{timestamp[:-1]}+00:00").astimezone(TIMEZONE)
+        except (TypeError, ValueError):
+            pass
+    return parsed_timestamps
+
+
+# The helpers below perform the same coercions as the CareRequest field validators,
+# so that checked values can be assembled with CareRequest.construct() without a second validation pass
+
+def check_str(fields: dict, field: str, required: bool = True) -> Optional[str]:
+    value = fields.get(field)
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (float, int, decimal.Decimal)) and not isinstance(value, bool):
+        return str(value)
+    if value is None and not required:
+        return None
+    raise ConversionError(f'invalid {field}')
+
+
+def check_pattern(fields: dict, field: str, pattern) -> str:
+    value = check_str(fields, field)
+    if not pattern.match(value):
+        raise ConversionError(f'invalid {field}')
+    return value
+
+
+def check_enum(fields: dict, field: str, enum):
+    try:
+        return enum(fields.get(field))
+    except ValueError:
+        raise ConversionError(f'invalid {field}')
+
+
+def check_date(fields: dict, field: str, required: bool = True) -> Optional[datetime.date]:
+    value = fields.get(field)
+    if not value:
+        if required:
+            raise ConversionError(f'missing {field}')
+        return None
+    try:
+        return normalise_date(value)
+    except (TypeError, ValueError):
+        raise ConversionError(f'invalid {field}')
+
+
+def check_timestamp(fields: dict, field: str, timestamps: Dict[str, datetime.datetime],
+                    required: bool = True) -> Optional[datetime.datetime]:
+    value = fields.get(field)
+    if not value:
+        if required:
+            raise ConversionError(f'missing {field}')
+        return None
+    if value not in timestamps:
+        raise ConversionError(f'invalid {field}')
+    return timestamps[value]
+
+
+def check_phone_number(fields: dict, field: str) -> str:
+    try:
+        return normalise_phone_number(fields.get(field))
+    except (AttributeError, TypeError, phonenumbers.NumberParseException):
+        raise ConversionError(f'invalid {field}')
+
+
+def check_email(fields: dict, field: str) -> Optional[str]:
+    value = check_str(fields, field, required=False)
+    if value is None:
+        return None
+    try:
+        return normalise_email(value)
+    except (TypeError, ValueError):
+        raise ConversionError(f'invalid {field}')
+
+
+def check_decimal(fields: dict, field: str) -> decimal.Decimal:
+    try:
+        value = decimal.Decimal(str(fields.get(field)).strip())
+    except decimal.DecimalException:
+        raise ConversionError(f'invalid {field}')
+    if not value.is_finite():
+        raise ConversionError(f'invalid {field}')
+    return value
+
+
+def check_image_url(fields: dict, field: str) -> Optional[str]:
+    attachments = fields.get(field)
+    if not attachments:
+        return None
+    try:
+        url = attachments[0].get('url')
+    except (AttributeError, IndexError, KeyError, TypeError):
+        raise ConversionError(f'invalid {field}')
+    if url is None:
+        return None
+    if not isinstance(url, str) or not url.startswith(('http://', 'https://')) or len(url) > MAX_URL_LENGTH:
+        raise ConversionError(f'invalid {field}')
+    return url
+
+
+def check_symptoms(fields: dict, field: str) -> List[Symptom]:
+    symptoms = fields.get(field, [])
+    if not isinstance(symptoms, (list, tuple, set)):
+        raise ConversionError(f'invalid {field}')
+    try:
+        return [Symptom(symptom) for symptom in symptoms]
+    except ValueError:
+        raise ConversionError(f'invalid {field}')
+
+
+def check_citizen_id(fields: dict) -> str:
+    citizen_id = fields.get('Citizen ID')
+    if not citizen_id:
+        raise ConversionError('missing Citizen ID')
+    if not isinstance(citizen_id, str) or not CITIZEN_ID_PATTERN.match(citizen_id.replace('-', '')):
+        raise ConversionError('invalid Citizen ID')
+    return citizen_id.replace('-', '')
+
+
+class FieldConversion(NamedTuple):
+    # The Airtable fields a CareRequest field is built from
+    airtable_fields: Tuple[str, ...]
+    # The raw value, validated by the model in strict mode
+    value: Callable[[dict, Dict[str, datetime.datetime]], Any]
+    # The value checked by the helpers above, for CareRequest.construct()
+    checked_value: Callable[[dict, Dict[str, datetime.datetime]], Any]
+
+
+def convert_field(airtable_field: str, check: Callable = check_str, *args, **kwargs) -> FieldConversion:
+    return FieldConversion((airtable_field,), lambda fields, timestamps: fields.get(airtable_field),
+                           lambda fields, timestamps: check(fields, airtable_field, *args, **kwargs))
+
+
+def convert_optional_field(airtable_field: str, check: Callable = check_str, **kwargs) -> FieldConversion:
+    return convert_field(airtable_field, check, required=False, **kwargs)
+
+
+def convert_date_field(airtable_field: str, required: bool = True) -> FieldConversion:
+    return FieldConversion((airtable_field,), lambda fields, timestamps: fields.get(airtable_field) or None,
+                           lambda fields, timestamps: check_date(fields, airtable_field, required=required))
+
+
+def convert_timestamp_field(airtable_field: str, required: bool = True) -> FieldConversion:
+    return FieldConversion(
+        (airtable_field,), lambda fields, timestamps: timestamps.get(fields.get(airtable_field)),
+        lambda fields, timestamps: check_timestamp(fields, airtable_field, timestamps, required=required))
+
+
+def convert_phone_number_field(airtable_field: str) -> FieldConversion:
+    return FieldConversion((airtable_field,),
+                           lambda fields, timestamps: normalise_phone_number(fields.get(airtable_field)),
+                           lambda fields, timestamps: check_phone_number(fields, airtable_field))
+
+
+# In CareRequest field order, which is also the order in which records are checked
+CARE_REQUEST_FIELD_CONVERSIONS: Dict[str, FieldConversion] = {
+    'citizen_id': FieldConversion(
+        ('Citizen ID',),
+        lambda fields, timestamps: fields.get('Citizen ID').replace("-", "") if fields.get('Citizen ID') else None,
+        lambda fields, timestamps: check_citizen_id(fields)),
+    'first_name': convert_field('First Name'),
+    'last_name': convert_field('Last Name'),
+    'phone_number': convert_phone_number_field('Phone Number'),
+    'email': convert_field('Email', check_email),
+    'sex': convert_field('Sex', check_enum, Sex),
+    'date_of_birth': convert_date_field('Date of Birth'),
+    'status': convert_field('Status', check_enum, RequestStatus),
+    'street_address': convert_field('Street Address'),
+    'subdistrict': convert_field('Subdistrict'),
+    'district': convert_field('District'),
+    'province': convert_field('Province'),
+    'postal_code': convert_field('Postal Code', check_pattern, POSTAL_CODE_PATTERN),
+    'request_datetime': convert_timestamp_field('Request Datetime'),
+    'channel': FieldConversion((), lambda fields, timestamps: CHANNEL_NAME,
+                               lambda fields, timestamps: Channel(CHANNEL_NAME)),
+    'covid_test_document_image_url': FieldConversion(
+        ('Covid Test Document Image',),
+        lambda fields, timestamps: fields.get('Covid Test Document Image')[0].get(
+            'url') if fields.get('Covid Test Document Image') else None,
+        lambda fields, timestamps: check_image_url(fields, 'Covid Test Document Image')),
+    'covid_test_location_type': convert_field('Covid Test Location Type', check_enum, CovidTestLocationType),
+    'covid_test_location_name': convert_field('Covid Test Location Name'),
+    'covid_test_date': convert_date_field('Covid Test Date'),
+    'covid_test_confirmation_date': convert_date_field('Covid Test Confirmation Date', required=False),
+    'symptoms': FieldConversion(('Symptoms',), lambda fields, timestamps: fields.get('Symptoms', []),
+                                lambda fields, timestamps: check_symptoms(fields, 'Symptoms')),
+    'symptoms_level': convert_field('Symptoms Level', check_enum, SymptomsLevel),
+    'other_symptoms': convert_optional_field('Other Symptoms'),
+    'care_status': convert_field('Care Status', check_enum, CareStatus),
+    'care_provider_name': convert_optional_field('Care Provider Name'),
+    'last_care_status_change_datetime': convert_timestamp_field('Last Care Status Change Datetime', required=False),
+    'location_latitude': convert_field('Location Latitude', check_decimal),
+    'location_longitude': convert_field('Location Longitude', check_decimal),
+    'caretaker_first_name': convert_field('Caretaker First Name'),
+    'caretaker_last_name': convert_field('Caretaker Last Name'),
+    'caretaker_email': convert_field('Caretaker Email', check_email),
+    'caretaker_phone_number': convert_phone_number_field('Caretaker Phone Number'),
+    'caretaker_relationship': convert_field('Caretaker Relationship'),
+    'checker': convert_optional_field('Checker'),
+    'note': convert_optional_field('Note'),
+    'last_status_change_datetime': convert_timestamp_field('Last Status Change Datetime', required=False),
+}
+
+
+def get_airtable_fields(model: Type[BaseModel]) -> List[str]:
+    airtable_fields = [airtable_field for name in model.__fields__
+                       for airtable_field in CARE_REQUEST_FIELD_CONVERSIONS[name].airtable_fields]
+    # Without any fields[] Airtable sends every column, e.g. for fields=channel
+    return airtable_fields or [PROJECTION_PLACEHOLDER_FIELD]
+
+
+def build_care_request(fields: dict, timestamps: Optional[Dict[str, datetime.datetime]] = None,
+                       model: Type[BaseModel] = CareRequest) -> BaseModel:
+    if timestamps is None:
+        timestamps = parse_airtable_timestamps([{'fields': fields}])
+    return model(**{name: CARE_REQUEST_FIELD_CONVERSIONS[name].value(fields, timestamps) for name in model.__fields__})
+
+
+def build_checked_care_request(fields: dict, timestamps: Dict[str, datetime.datetime],
+                               model: Type[BaseModel] = CareRequest) -> BaseModel:
+    return model.construct(**{name: CARE_REQUEST_FIELD_CONVERSIONS[name].checked_value(fields, timestamps)
+                              for name in model.__fields__})
+
+
+def log_dropped_records(dropped: Counter):
+    for reason, count in dropped.items():
+        dropped_records_total.inc(count, reason=reason)
+    if sum(dropped.values()) > 0:
+        logging.warn(f'A total of {sum(dropped.values())} records was unable to be created: ' +
+                     ', '.join(f'{reason} ({count})' for reason, count in dropped.most_common()))
+
+
+def convert_airtable_records(records: List, strict: Optional[bool] = None, dropped: Optional[Counter] = None,
+                             model: Type[BaseModel] = CareRequest) -> List[BaseModel]:
+    strict = CONVERSION_STRICT_VALIDATION if strict is None else strict
+    summary = Counter() if dropped is None else dropped
+    timestamps = parse_airtable_timestamps(records)
+    response_data = []
+
+    for record in records:
+        fields = record.get('fields', {})
+        try:
+            if strict:
+                response_data.append(build_care_request(fields, timestamps, model))
+            else:
+                response_data.append(build_checked_care_request(fields, timestamps, model))
+        except ConversionError as e:
+            summary[e.reason] += 1
+        except ValidationError as e:
+            summary[f"invalid {', '.join(str(error['loc'][0]) for error in e.errors())}"] += 1
+        except (AttributeError, phonenumbers.NumberParseException) as e:
+            summary[type(e).__name__] += 1
+
+    if dropped is None:
+        log_dropped_records(summary)
+    return response_data
+
+
+def encode_json_default(value):
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+# The care requests are already validated (or checked) CareRequest models without nested models, so their field
+# values can be encoded directly, giving the same JSON as FastAPI's response_model validation and encoding
+def dump_care_request_response(care_requests: List[BaseModel], **extra) -> bytes:
+    return orjson.dumps({'data': [care_request.__dict__ for care_request in care_requests], **extra},
+                        default=encode_json_default)
+
+
+def dump_care_request_line(care_request: BaseModel) -> bytes:
+    return orjson.dumps(care_request.__dict__, default=encode_json_default, option=orjson.OPT_APPEND_NEWLINE)
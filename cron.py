@@ -1,59 +1,235 @@
-import datetime
+import asyncio
+import fcntl
+import itertools
 import json
 import logging
 import os
-from typing import List
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+from typing import Iterator, List, NamedTuple
 
 import dotenv
 import requests
 from pydantic import ValidationError
 from starlette import status
+from starlette.concurrency import iterate_in_threadpool
 
-from main import (CareProvidedReport, build_airtable_datetime_expression,
-                  build_airtable_formula_chain, get_airtable_records,
-                  hyphenate_citizen_id, report_provided_care)
+from airtable import close_airtable_client
+from care_reports import process_care_provided_report
+from cmc_snapshot import get_cmc_row_hashes, hash_cmc_row, save_cmc_row_hashes
+from metrics import (cmc_poll_failures_total, cmc_poll_seconds,
+                     cmc_requests_total, cmc_rows_total, flush_metrics)
+from models import CareProvidedReport
+from update_queue import enqueue_care_status_updates
+from utils import SQLITE_MAX_VARIABLES, iter_json_array
 
 dotenv.load_dotenv()
 
-CMC_API_BASE_URL = 'http://cmc.bangkok.go.th/cvformapi/api/nawaminsent'
+CMC_API_BASE_URL = os.environ.get('CMC_API_BASE_URL', 'http://cmc.bangkok.go.th/cvformapi/api/nawaminsent')
 CMC_API_KEY = os.environ.get('CMC_API_KEY')
+CMC_STREAM_CHUNK_SIZE = 65536
 
+# In daemon mode the poll interval halves after a poll that found changes and doubles after an idle or failed one
+CMC_POLL_MIN_INTERVAL = float(os.environ.get('CMC_POLL_MIN_INTERVAL', 60))
+CMC_POLL_MAX_INTERVAL = float(os.environ.get('CMC_POLL_MAX_INTERVAL', 1800))
+CMC_POLL_JITTER = float(os.environ.get('CMC_POLL_JITTER', 0.1))
+CMC_POLL_LOCK_FILE = os.environ.get('CMC_POLL_LOCK_FILE', os.path.join(tempfile.gettempdir(), 'cmc-poll.lock'))
+# The daemon reports on its polls in this JSON file when it is set
+CMC_POLL_STATUS_FILE = os.environ.get('CMC_POLL_STATUS_FILE')
+# Hand reports to the write-behind queue flushed by the API workers instead of updating Airtable in the poller
+CMC_WRITE_BEHIND = os.environ.get('CMC_WRITE_BEHIND', '').lower() in ('1', 'true')
 
-def poll_for_new_care_status_update():
-    if not CMC_API_KEY:
-        raise ConnectionAbortedError('Unable to retrieve API key')
+# Kept for the lifetime of the process so that daemon mode reuses the connection to CMC
+cmc_session = requests.Session()
 
-    response = requests.get(CMC_API_BASE_URL, params={'token': CMC_API_KEY})
-    rows = response.json()
 
-    reports: List[CareProvidedReport] = []
+class CmcPollResult(NamedTuple):
+    row_counts: Counter
+    forwarded: int
+    fetch_seconds: float
+    update_seconds: float
 
-    skipped_rows = []
 
-    for row in rows:
-        try:
-            if row.get('transfer_status') != '1':
-                skipped_rows.append(row)
-                continue
-            reports.append(CareProvidedReport(citizen_id=row.get('citizen_id'),
-                           care_provider_name=row.get('hos_name')))
-        except ValidationError as e:
-            skipped_rows.append(row)
-            logging.error(f'A row was dropped due to a Validation error ({row})', exc_info=e)
+def iter_cmc_rows() -> Iterator[dict]:
+    with cmc_session.get(CMC_API_BASE_URL, params={'token': CMC_API_KEY}, stream=True) as response:
+        cmc_requests_total.inc(status=response.status_code)
+        response.raise_for_status()
+        # JSON is always UTF-8, whatever the Content-Type header says
+        response.encoding = 'utf-8'
+        yield from iter_json_array(response.iter_content(CMC_STREAM_CHUNK_SIZE, decode_unicode=True))
+
 
-    if len(skipped_rows) > 0:
-        logging.warn(f"A total of {len(skipped_rows)} rows was unable to be created.")
+def iter_cmc_row_chunks() -> Iterator[List[dict]]:
+    rows = iter_cmc_rows()
+    return iter(lambda: list(itertools.islice(rows, SQLITE_MAX_VARIABLES)), [])
 
-    response = report_provided_care(reports)
 
-    if response.status_code // 100 != 2:
-        logging.error(f'HTTP Response is not 200: got status {response.status_code}')
-        raise ConnectionError(f'HTTP Response is not 200: got status {response.status_code}')
+async def poll_for_new_care_status_update() -> CmcPollResult:
+    if not CMC_API_KEY:
+        raise ConnectionAbortedError('Unable to retrieve API key')
+
+    started_at = time.monotonic()
+
+    reports: List[CareProvidedReport] = []
+    row_counts = Counter()
+
+    skipped_rows = 0
+    # Rows that need no further handling until they change, and forwarded rows that wait for the result of the update
+    handled_row_hashes = []
+    forwarded_row_hashes = {}
+
+    # The download and parsing block, so each chunk of rows is read in the threadpool to keep the event loop free
+    async for chunk in iterate_in_threadpool(iter_cmc_row_chunks()):
+        known_row_hashes = get_cmc_row_hashes([str(row.get('citizen_id')) for row in chunk])
+        for row in chunk:
+            citizen_id = str(row.get('citizen_id'))
+            row_hash = hash_cmc_row(row)
+            known_row_hash, retry = known_row_hashes.get(citizen_id, (None, False))
+            if known_row_hash != row_hash:
+                row_counts['changed' if known_row_hash else 'new'] += 1
+            elif retry:
+                row_counts['retried'] += 1
+            else:
+                row_counts['unchanged'] += 1
+                continue
 
-    if response.status_code == status.HTTP_207_MULTI_STATUS:
-        logging.warn(f'Partial update, skipped records:\n{json.loads(response.body)}')
-    logging.warn(f'Updated {len(rows) - len(skipped_rows)} records to Airtable.')
+            try:
+                if row.get('transfer_status') != '1':
+                    skipped_rows += 1
+                    handled_row_hashes.append((citizen_id, row_hash, False))
+                    continue
+                reports.append(CareProvidedReport(citizen_id=row.get('citizen_id'),
+                               care_provider_name=row.get('hos_name')))
+                forwarded_row_hashes[citizen_id] = row_hash
+            except ValidationError as e:
+                skipped_rows += 1
+                handled_row_hashes.append((citizen_id, row_hash, False))
+                logging.error(f'A row was dropped due to a Validation error ({row})', exc_info=e)
+
+    logging.warn(f"CMC rows: {row_counts['new']} new, {row_counts['changed']} changed, " +
+                 f"{row_counts['unchanged']} unchanged, {row_counts['retried']} retried.")
+
+    if skipped_rows > 0:
+        logging.warn(f"A total of {skipped_rows} rows was unable to be created.")
+
+    fetched_at = time.monotonic()
+
+    if len(reports) > 0 and CMC_WRITE_BEHIND:
+        # The queue retries failed and unmatched reports itself
+        enqueue_care_status_updates(reports)
+        handled_row_hashes += [(citizen_id, row_hash, False) for citizen_id, row_hash in forwarded_row_hashes.items()]
+    elif len(reports) > 0:
+        content, status_code = await process_care_provided_report(reports)
+
+        if status_code // 100 != 2:
+            logging.error(f'HTTP Response is not 200: got status {status_code}')
+            raise ConnectionError(f'HTTP Response is not 200: got status {status_code}')
+
+        if status_code == status.HTTP_207_MULTI_STATUS:
+            logging.warn(f'Partial update, skipped records:\n{content}')
+
+        # Skipped and failed reports are forwarded again on the next run, e.g. once the citizen's request shows up
+        updated_citizen_ids = {report['citizen_id'] for report in content['updated']}
+        handled_row_hashes += [(citizen_id, row_hash, citizen_id not in updated_citizen_ids)
+                               for citizen_id, row_hash in forwarded_row_hashes.items()]
+
+    save_cmc_row_hashes(handled_row_hashes)
+    logging.warn(f'Updated {len(reports)} records to Airtable.')
+
+    result = CmcPollResult(row_counts, len(reports), fetched_at - started_at, time.monotonic() - fetched_at)
+    cmc_poll_seconds.observe(result.fetch_seconds, phase='fetch')
+    cmc_poll_seconds.observe(result.update_seconds, phase='update')
+    for state, count in row_counts.items():
+        cmc_rows_total.inc(count, state=state)
+    return result
+
+
+def acquire_poll_lock() -> int:
+    fd = os.open(CMC_POLL_LOCK_FILE, os.O_RDWR | os.O_CREAT, 0o666)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        raise RuntimeError(f'Another CMC poller holds {CMC_POLL_LOCK_FILE}')
+    # Held until the process exits
+    return fd
+
+
+def write_poll_status(poll_status: dict):
+    if not CMC_POLL_STATUS_FILE:
+        return
+    temporary_path = f'{CMC_POLL_STATUS_FILE}.tmp'
+    with open(temporary_path, 'w') as f:
+        json.dump(poll_status, f)
+    os.replace(temporary_path, CMC_POLL_STATUS_FILE)
+
+
+def get_next_poll_interval(interval: float, changed: bool) -> float:
+    if changed:
+        return max(CMC_POLL_MIN_INTERVAL, interval / 2)
+    return min(CMC_POLL_MAX_INTERVAL, interval * 2)
+
+
+async def run_daemon():
+    interval = CMC_POLL_MIN_INTERVAL
+    poll_status = {'polls': 0, 'failures': 0, 'consecutive_failures': 0}
+    try:
+        while True:
+            started_at = time.time()
+            try:
+                result = await poll_for_new_care_status_update()
+            except Exception as e:
+                logging.error('CMC poll failed', exc_info=e)
+                cmc_poll_failures_total.inc()
+                poll_status['failures'] += 1
+                poll_status['consecutive_failures'] += 1
+                poll_status['last_error'] = repr(e)
+                interval = get_next_poll_interval(interval, False)
+            else:
+                poll_status.update({
+                    'consecutive_failures': 0,
+                    'last_success_at': time.time(),
+                    'last_rows': dict(result.row_counts),
+                    'last_forwarded': result.forwarded,
+                    'last_fetch_seconds': result.fetch_seconds,
+                    'last_update_seconds': result.update_seconds,
+                })
+                interval = get_next_poll_interval(
+                    interval, result.row_counts['new'] + result.row_counts['changed'] > 0)
+
+            delay = interval * random.uniform(1 - CMC_POLL_JITTER, 1 + CMC_POLL_JITTER)
+            poll_status.update({
+                'polls': poll_status['polls'] + 1,
+                'last_started_at': started_at,
+                'last_duration_seconds': time.time() - started_at,
+                'interval_seconds': interval,
+                'next_poll_at': time.time() + delay,
+            })
+            write_poll_status(poll_status)
+            flush_metrics()
+            logging.warn(f'Next CMC poll in {delay:.0f} seconds.')
+            await asyncio.sleep(delay)
+    finally:
+        await close_airtable_client()
+
+
+async def run_once():
+    try:
+        await poll_for_new_care_status_update()
+    except Exception:
+        cmc_poll_failures_total.inc()
+        raise
+    finally:
+        await close_airtable_client()
+        flush_metrics()
 
 
 if __name__ == '__main__':
-    poll_for_new_care_status_update()
+    poll_lock = acquire_poll_lock()
+    if '--daemon' in sys.argv[1:]:
+        asyncio.get_event_loop().run_until_complete(run_daemon())
+    else:
+        asyncio.get_event_loop().run_until_complete(run_once())
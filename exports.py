@@ -0,0 +1,244 @@
+import asyncio
+import csv
+import datetime
+import decimal
+import enum
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+import time
+from collections import Counter
+from contextlib import ExitStack
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+import dotenv
+from pydantic import BaseModel
+
+from airtable import close_airtable_client, iter_airtable_record_pages
+from conversion import convert_airtable_records, log_dropped_records
+from models import CareRequest
+from replica import is_replica_fresh, iter_replica_record_pages
+from utils import DATA_DIRECTORY
+
+dotenv.load_dotenv()
+
+EXPORTS_DIRECTORY = os.environ.get('EXPORTS_DIRECTORY', os.path.join(DATA_DIRECTORY, 'exports'))
+EXPORTS_INTERVAL = int(os.environ.get('EXPORTS_INTERVAL', 3600))
+# Older snapshots, and the deltas leading up to them, are deleted
+EXPORTS_KEEP = int(os.environ.get('EXPORTS_KEEP', 4))
+EXPORTS_MANIFEST_NAME = 'manifest.json'
+EXPORTS_CHUNK_SIZE = 64 * 1024
+EXPORT_FILE_NAME_PATTERN = re.compile(r'^(snapshot|delta)-[0-9TZ-]+\.csv\.gz$')
+
+# Airtable record IDs identify rows across snapshots, a citizen may have more than one care request
+EXPORT_COLUMNS = ['id'] + list(CareRequest.__fields__)
+DELTA_COLUMNS = ['operation'] + EXPORT_COLUMNS
+DELTA_UPSERT = 'upsert'
+DELTA_DELETE = 'delete'
+
+
+def format_export_value(value) -> str:
+    if value is None:
+        return ''
+    if isinstance(value, enum.Enum):
+        return value.value
+    if isinstance(value, list):
+        return ';'.join(format_export_value(item) for item in value)
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return str(value)
+    return str(value)
+
+
+def build_export_row(record_id: str, care_request: BaseModel) -> List[str]:
+    return [record_id] + [format_export_value(value) for value in care_request.__dict__.values()]
+
+
+def hash_export_row(row: List[str]) -> str:
+    return hashlib.sha1('\x1f'.join(row).encode()).hexdigest()
+
+
+def get_export_path(name: str) -> str:
+    return os.path.join(EXPORTS_DIRECTORY, name)
+
+
+def read_export_manifest() -> dict:
+    try:
+        with open(get_export_path(EXPORTS_MANIFEST_NAME)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'snapshot': None, 'snapshots': [], 'deltas': []}
+
+
+def write_export_manifest(manifest: dict):
+    path = get_export_path(EXPORTS_MANIFEST_NAME)
+    with open(f'{path}.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(f'{path}.tmp', path)
+
+
+def is_export_file_name(name: str) -> bool:
+    return EXPORT_FILE_NAME_PATTERN.match(name) is not None
+
+
+def iter_export_file_range(name: str, first: int, last: int) -> Iterator[bytes]:
+    with open(get_export_path(name), 'rb') as f:
+        f.seek(first)
+        remaining = last - first + 1
+        while remaining > 0:
+            chunk = f.read(min(EXPORTS_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def read_snapshot_row_hashes(name: str) -> Dict[str, str]:
+    with gzip.open(get_export_path(name), 'rt', newline='') as f:
+        reader = csv.reader(f)
+        next(reader)
+        return {row[0]: hash_export_row(row) for row in reader}
+
+
+def convert_export_rows(records: List, dropped: Counter) -> Iterator[List[str]]:
+    # One record at a time, to keep each care request paired with its record ID when others are dropped
+    for record in records:
+        for care_request in convert_airtable_records([record], dropped=dropped):
+            yield build_export_row(record['id'], care_request)
+
+
+async def iter_export_record_pages() -> AsyncIterator[List]:
+    if is_replica_fresh():
+        for page in iter_replica_record_pages(None, None, None, None, None, datetime.timezone.utc):
+            yield page
+    else:
+        async for page in iter_airtable_record_pages({'pageSize': 100}):
+            yield page
+
+
+async def write_snapshot(name: str, delta_name: Optional[str], previous_row_hashes: Dict[str, str]) -> Tuple[int, int]:
+    # Both files are written under temporary names and only appear once complete
+    temporary_paths = [get_export_path(f'{export_name}.tmp') for export_name in (name, delta_name) if export_name]
+    row_hashes = {}
+    dropped = Counter()
+    delta_records = 0
+
+    try:
+        with ExitStack() as stack:
+            snapshot_writer = csv.writer(stack.enter_context(gzip.open(temporary_paths[0], 'wt', newline='')))
+            snapshot_writer.writerow(EXPORT_COLUMNS)
+            delta_writer = None
+            if delta_name:
+                delta_writer = csv.writer(stack.enter_context(gzip.open(temporary_paths[1], 'wt', newline='')))
+                delta_writer.writerow(DELTA_COLUMNS)
+
+            async for page in iter_export_record_pages():
+                for row in convert_export_rows(page, dropped):
+                    snapshot_writer.writerow(row)
+                    row_hash = row_hashes[row[0]] = hash_export_row(row)
+                    if delta_writer and previous_row_hashes.get(row[0]) != row_hash:
+                        delta_writer.writerow([DELTA_UPSERT] + row)
+                        delta_records += 1
+            if delta_writer:
+                for record_id in previous_row_hashes.keys() - row_hashes.keys():
+                    # Padded to the header, so every row of the CSV has the same number of columns
+                    delta_writer.writerow([DELTA_DELETE, record_id] + [''] * (len(DELTA_COLUMNS) - 2))
+                    delta_records += 1
+    except BaseException:
+        for temporary_path in temporary_paths:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+        raise
+
+    log_dropped_records(dropped)
+    for temporary_path in temporary_paths:
+        os.replace(temporary_path, temporary_path[:-len('.tmp')])
+    return len(row_hashes), delta_records
+
+
+def get_snapshot_suffix(name: str) -> str:
+    return name[len('snapshot-'):-len('.csv.gz')]
+
+
+async def export_snapshot() -> dict:
+    started_at = time.time()
+    os.makedirs(EXPORTS_DIRECTORY, exist_ok=True)
+    manifest = read_export_manifest()
+    previous = manifest['snapshot']
+    # Without the previous snapshot there is nothing to compute a delta against
+    if previous and not os.path.exists(get_export_path(previous['name'])):
+        previous = None
+
+    generated_at = datetime.datetime.now(datetime.timezone.utc)
+    suffix = generated_at.strftime('%Y%m%dT%H%M%SZ')
+    name = f'snapshot-{suffix}.csv.gz'
+    delta_name = f"delta-{get_snapshot_suffix(previous['name'])}-{suffix}.csv.gz" if previous else None
+
+    records, delta_records = await write_snapshot(
+        name, delta_name, read_snapshot_row_hashes(previous['name']) if previous else {})
+
+    snapshot = {
+        'name': name,
+        'generated_at': generated_at.isoformat(),
+        'records': records,
+        'size': os.path.getsize(get_export_path(name)),
+    }
+    manifest['snapshot'] = snapshot
+    manifest['snapshots'].append(snapshot)
+    if delta_name:
+        manifest['deltas'].append({
+            'name': delta_name,
+            'from': previous['name'],
+            'to': name,
+            'records': delta_records,
+            'size': os.path.getsize(get_export_path(delta_name)),
+        })
+
+    # Deltas are kept as long as the snapshot they start from, so that any listed snapshot can be brought up to date
+    expired = manifest['snapshots'][:-EXPORTS_KEEP]
+    manifest['snapshots'] = manifest['snapshots'][-EXPORTS_KEEP:]
+    kept_names = {kept['name'] for kept in manifest['snapshots']}
+    expired += [delta for delta in manifest['deltas'] if delta['from'] not in kept_names]
+    manifest['deltas'] = [delta for delta in manifest['deltas'] if delta['from'] in kept_names]
+    write_export_manifest(manifest)
+    for export in expired:
+        try:
+            os.remove(get_export_path(export['name']))
+        except FileNotFoundError:
+            pass
+
+    logging.warn(f'Exported a snapshot of {records} records ' +
+                 (f'and a delta of {delta_records} ' if delta_name else '') +
+                 f'in {time.time() - started_at:.1f}s.')
+    return snapshot
+
+
+async def run_exports():
+    try:
+        while True:
+            try:
+                await export_snapshot()
+            except Exception as e:
+                logging.error('Snapshot export failed', exc_info=e)
+            await asyncio.sleep(EXPORTS_INTERVAL)
+    finally:
+        await close_airtable_client()
+
+
+async def run_export_once():
+    try:
+        await export_snapshot()
+    finally:
+        await close_airtable_client()
+
+
+if __name__ == '__main__':
+    if '--once' in sys.argv[1:]:
+        asyncio.get_event_loop().run_until_complete(run_export_once())
+    else:
+        asyncio.get_event_loop().run_until_complete(run_exports())
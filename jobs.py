@@ -0,0 +1,180 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+import uuid
+from typing import List, Optional
+
+import dotenv
+from starlette.concurrency import run_in_threadpool
+
+from care_reports import process_care_provided_report
+from models import CareProvidedReport
+from utils import DATA_DIRECTORY, connect_sqlite
+
+dotenv.load_dotenv()
+
+JOBS_DATABASE_PATH = os.environ.get('JOBS_DATABASE_PATH', os.path.join(DATA_DIRECTORY, 'jobs.sqlite3'))
+JOBS_POLL_INTERVAL = float(os.environ.get('JOBS_POLL_INTERVAL', 5))
+# A running job whose worker has not checked in for this long (e.g. the worker was restarted) is picked up again
+JOBS_STALE_AFTER = int(os.environ.get('JOBS_STALE_AFTER', 300))
+JOBS_HEARTBEAT_INTERVAL = 30
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_FINISHED = 'finished'
+JOB_FAILED = 'failed'
+
+_jobs_connection: Optional[sqlite3.Connection] = None
+_jobs_available: Optional[asyncio.Event] = None
+
+
+def get_jobs_connection() -> sqlite3.Connection:
+    global _jobs_connection
+    if _jobs_connection is None:
+        _jobs_connection = connect_sqlite(JOBS_DATABASE_PATH, '''
+            CREATE TABLE IF NOT EXISTS care_provided_report_jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                total INTEGER NOT NULL,
+                records_to_update INTEGER,
+                records_written INTEGER NOT NULL DEFAULT 0,
+                records_failed INTEGER NOT NULL DEFAULT 0,
+                result TEXT,
+                status_code INTEGER,
+                error TEXT,
+                claim TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                heartbeat_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS care_provided_report_jobs_status
+                ON care_provided_report_jobs (status, created_at);
+        ''')
+    return _jobs_connection
+
+
+def get_jobs_available() -> asyncio.Event:
+    global _jobs_available
+    if _jobs_available is None:
+        _jobs_available = asyncio.Event()
+    return _jobs_available
+
+
+def insert_care_provided_report_job(care_provided_report: List[CareProvidedReport]) -> str:
+    job_id = str(uuid.uuid4())
+    now = time.time()
+    # Run in the threadpool, so it writes through a connection of its own rather than the one the job worker uses on
+    # the event loop
+    connection = connect_sqlite(JOBS_DATABASE_PATH)
+    try:
+        with connection:
+            connection.execute(
+                'INSERT INTO care_provided_report_jobs (id, status, payload, total, created_at, updated_at) ' +
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (job_id, JOB_QUEUED, json.dumps([report.dict() for report in care_provided_report]),
+                 len(care_provided_report), now, now))
+    finally:
+        connection.close()
+    return job_id
+
+
+async def enqueue_care_provided_report_job(care_provided_report: List[CareProvidedReport]) -> str:
+    # Creates the table on first use
+    get_jobs_connection()
+    job_id = await run_in_threadpool(insert_care_provided_report_job, care_provided_report)
+    get_jobs_available().set()
+    return job_id
+
+
+def get_care_provided_report_job(job_id: str) -> Optional[dict]:
+    row = get_jobs_connection().execute('SELECT * FROM care_provided_report_jobs WHERE id = ?',
+                                        (job_id,)).fetchone()
+    if row is None:
+        return None
+    return {
+        'id': row['id'],
+        'status': row['status'],
+        'total': row['total'],
+        'progress': {
+            'records_to_update': row['records_to_update'],
+            'records_written': row['records_written'],
+            'records_failed': row['records_failed'],
+        },
+        'created_at': row['created_at'],
+        'updated_at': row['updated_at'],
+        'status_code': row['status_code'],
+        'result': json.loads(row['result']) if row['result'] else None,
+        'error': row['error'],
+    }
+
+
+def claim_care_provided_report_job() -> Optional[sqlite3.Row]:
+    claim = str(uuid.uuid4())
+    now = time.time()
+    connection = get_jobs_connection()
+    with connection:
+        connection.execute(
+            'UPDATE care_provided_report_jobs SET status = ?, claim = ?, heartbeat_at = ?, updated_at = ? ' +
+            'WHERE id = (SELECT id FROM care_provided_report_jobs ' +
+            '            WHERE status = ? OR (status = ? AND heartbeat_at < ?) ORDER BY created_at LIMIT 1)',
+            (JOB_RUNNING, claim, now, now, JOB_QUEUED, JOB_RUNNING, now - JOBS_STALE_AFTER))
+    return connection.execute('SELECT * FROM care_provided_report_jobs WHERE claim = ?', (claim,)).fetchone()
+
+
+def update_care_provided_report_job(job_id: str, **values):
+    values['updated_at'] = time.time()
+    connection = get_jobs_connection()
+    with connection:
+        connection.execute(
+            f"UPDATE care_provided_report_jobs SET {', '.join(f'{key} = ?' for key in values)} WHERE id = ?",
+            list(values.values()) + [job_id])
+
+
+async def keep_job_alive(job_id: str):
+    while True:
+        await asyncio.sleep(JOBS_HEARTBEAT_INTERVAL)
+        update_care_provided_report_job(job_id, heartbeat_at=time.time())
+
+
+async def run_care_provided_report_job(job: sqlite3.Row):
+    logging.warn(f"Processing care provided report job {job['id']} ({job['total']} reports).")
+    heartbeat = asyncio.ensure_future(keep_job_alive(job['id']))
+    try:
+        care_provided_report = [CareProvidedReport(**report) for report in json.loads(job['payload'])]
+
+        def save_progress(records_to_update: int, records_written: int, records_failed: int):
+            update_care_provided_report_job(job['id'], records_to_update=records_to_update,
+                                            records_written=records_written, records_failed=records_failed,
+                                            heartbeat_at=time.time())
+
+        content, status_code = await process_care_provided_report(care_provided_report, save_progress)
+    except Exception as e:
+        logging.error(f"Care provided report job {job['id']} failed", exc_info=e)
+        update_care_provided_report_job(job['id'], status=JOB_FAILED, error=repr(e))
+    else:
+        update_care_provided_report_job(job['id'], status=JOB_FINISHED, result=json.dumps(content),
+                                        status_code=status_code)
+    finally:
+        heartbeat.cancel()
+
+
+async def run_care_provided_report_jobs():
+    jobs_available = get_jobs_available()
+    while True:
+        try:
+            job = claim_care_provided_report_job()
+            while job is not None:
+                await run_care_provided_report_job(job)
+                job = claim_care_provided_report_job()
+        except Exception as e:
+            logging.error('Unable to claim a care provided report job', exc_info=e)
+        jobs_available.clear()
+        try:
+            # Jobs queued by other workers are picked up on the next poll
+            await asyncio.wait_for(jobs_available.wait(), JOBS_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
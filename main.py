@@ -1,37 +1,114 @@
+import asyncio
 import datetime
-import logging
+import os
 import time
-from typing import List, Optional
+from collections import Counter
+from email.utils import formatdate
+from typing import AsyncIterator, List, Optional, Tuple, Type
 
-import phonenumbers
-import requests
-from backports.datetime_fromisoformat import MonkeyPatch
-from fastapi import FastAPI, HTTPException, Query, Request
+import orjson
+from fastapi import FastAPI, Header, HTTPException, Query, Request, Response
 from fastapi.openapi.docs import get_redoc_html, get_swagger_ui_html
 from fastapi.openapi.models import APIKey
 from fastapi.openapi.utils import get_openapi
 from fastapi.params import Depends
-from pydantic import ValidationError
+from pydantic import BaseModel
 from starlette import status
-from starlette.responses import JSONResponse, RedirectResponse
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+from starlette.responses import (FileResponse, JSONResponse, PlainTextResponse,
+                                 RedirectResponse, StreamingResponse)
+from starlette.status import HTTP_304_NOT_MODIFIED
+
+from airtable import (build_airtable_datetime_expression,
+                      build_airtable_formula_chain,
+                      build_airtable_match_expression, close_airtable_client,
+                      get_airtable_records, iter_airtable_scan_pages)
+from cache import REQUESTS_CACHE_TTL, requests_cache
+from care_reports import process_care_provided_report
+from changes import (CHANGES_HEARTBEAT_INTERVAL, CHANGES_MAX_WAIT,
+                     CHANGES_WATCH_INTERVAL, get_changes_head,
+                     is_cursor_expired, run_change_detector,
+                     wait_for_care_request_changes, watch_care_request_changes)
+from citizen_index import index_records, is_citizen_index_enabled
+from compression import CompressionMiddleware
+from conversion import (TIMEZONE, convert_airtable_records,
+                        dump_care_request_line, dump_care_request_response,
+                        get_airtable_fields, log_dropped_records)
+from exports import (get_export_path, is_export_file_name,
+                     iter_export_file_range, read_export_manifest)
+from jobs import (enqueue_care_provided_report_job,
+                  get_care_provided_report_job, run_care_provided_report_jobs)
+from metrics import (MetricsMiddleware, flush_metrics, render_metrics,
+                     requests_records, requests_stage_seconds,
+                     run_metrics_flush)
+from models import (CareProvidedReport, CareRequest,
+                    CareRequestChangesResponse, CareRequestField,
+                    CareRequestResponse, CareStatus, RequestStatus,
+                    ResponseFormat, SymptomsLevel, get_care_request_model)
+from profiling import (ProfilingMiddleware, get_profile_path,
+                       is_profile_file_name, list_profiles,
+                       render_profile_summary)
+from replica import (get_replica_modified_at, get_replica_synced_at,
+                     is_replica_fresh, iter_replica_record_pages,
+                     query_replica_records)
+from security import API_KEY_NAME, get_admin_api_key, get_api_key
+from update_queue import (enqueue_care_status_updates, get_update_queue_status,
+                          run_care_status_update_queue)
+from utils import build_etag, is_not_modified, parse_byte_range
 
-from airtable import (AIRTABLE_AUTH_HEADER, AIRTABLE_BASE_URL,
-                      AIRTABLE_REQUEST_DELAY,
-                      build_airtable_datetime_expression,
-                      build_airtable_formula_chain, get_airtable_records,
-                      get_citizen_id_matched_airtable_records)
-from models import (CareProvidedReport, CareRequest, CareRequestResponse,
-                    CareStatus, RequestStatus, SymptomsLevel)
-from security import API_KEY_NAME, get_api_key
-from utils import hyphenate_citizen_id
+app = FastAPI(docs_url=None, redoc_url=None, openapi_url=None)
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(MetricsMiddleware)
+# Outermost, so that a profile covers compression and metrics too
+app.add_middleware(ProfilingMiddleware)
 
-MonkeyPatch.patch_fromisoformat()
 
-TIMEZONE = datetime.timezone(datetime.timedelta(hours=7))
+@app.on_event("startup")
+async def start_care_provided_report_jobs():
+    app.state.care_provided_report_jobs = asyncio.ensure_future(run_care_provided_report_jobs())
 
-CHANNEL_NAME = 'BKKCOVID19CONNECT'
 
-app = FastAPI(docs_url=None, redoc_url=None, openapi_url=None)
+@app.on_event("shutdown")
+async def stop_care_provided_report_jobs():
+    app.state.care_provided_report_jobs.cancel()
+
+
+@app.on_event("startup")
+async def start_care_status_update_queue():
+    app.state.care_status_update_queue = asyncio.ensure_future(run_care_status_update_queue())
+
+
+@app.on_event("shutdown")
+async def stop_care_status_update_queue():
+    app.state.care_status_update_queue.cancel()
+
+
+@app.on_event("startup")
+async def start_change_feed():
+    app.state.change_detector = asyncio.ensure_future(run_change_detector())
+    app.state.change_watcher = asyncio.ensure_future(watch_care_request_changes())
+
+
+@app.on_event("shutdown")
+async def stop_change_feed():
+    app.state.change_detector.cancel()
+    app.state.change_watcher.cancel()
+
+
+@app.on_event("startup")
+async def start_metrics_flush():
+    app.state.metrics_flush = asyncio.ensure_future(run_metrics_flush())
+
+
+@app.on_event("shutdown")
+async def stop_metrics_flush():
+    app.state.metrics_flush.cancel()
+    flush_metrics()
+
+
+@app.on_event("shutdown")
+async def shutdown_airtable_client():
+    await close_airtable_client()
 
 
 @app.get("/openapi.json", tags=["documentation"])
@@ -78,14 +155,57 @@ async def route_logout_and_remove_cookie(request: Request):
     return response
 
 
-@app.get("/requests", response_model=CareRequestResponse)
-async def read_requests(last_status_change_since: Optional[datetime.datetime] = Query(None),
-                        last_status_change_until: Optional[datetime.datetime] = Query(None),
-                        status: Optional[List[RequestStatus]] = Query(None),
-                        care_status: Optional[List[CareStatus]] = Query(None),
-                        symptoms_level: Optional[List[SymptomsLevel]] = Query(None),
-                        api_key: APIKey = Depends(get_api_key)):
+async def stream_care_requests(pages: AsyncIterator[List], model: Type[BaseModel]) -> AsyncIterator[bytes]:
+    dropped = Counter()
+    record_count = 0
+    async for page in pages:
+        with requests_stage_seconds.time(stage='conversion'):
+            care_requests = convert_airtable_records(page, dropped=dropped, model=model)
+        record_count += len(care_requests)
+        # One chunk per page, as the compression middleware flushes every chunk
+        if len(care_requests) > 0:
+            yield b''.join(map(dump_care_request_line, care_requests))
+    log_dropped_records(dropped)
+    requests_records.observe(record_count)
+
+
+def serialise_care_requests(records: List, model: Type[BaseModel]) -> Tuple[bytes, int]:
+    with requests_stage_seconds.time(stage='conversion'):
+        care_requests = convert_airtable_records(records, model=model)
+    with requests_stage_seconds.time(stage='serialisation'):
+        return dump_care_request_response(care_requests), len(care_requests)
+
+
+def convert_care_request_changes(changes: List[Tuple[int, dict]],
+                                 model: Type[BaseModel]) -> List[Tuple[int, BaseModel]]:
+    dropped = Counter()
+    with requests_stage_seconds.time(stage='conversion'):
+        care_requests = [(seq, care_request) for seq, record in changes
+                         for care_request in convert_airtable_records([record], dropped=dropped, model=model)]
+    log_dropped_records(dropped)
+    return care_requests
+
+
+async def stream_care_request_changes(request: Request, cursor: int, model: Type[BaseModel]) -> AsyncIterator[bytes]:
+    # Sent straight away so that the response headers are not held back until the first change
+    yield f'retry: {int(CHANGES_WATCH_INTERVAL * 1000)}\n\n'.encode()
+    while not await request.is_disconnected():
+        changes = await wait_for_care_request_changes(cursor, CHANGES_HEARTBEAT_INTERVAL)
+        if len(changes) == 0:
+            # A comment line keeps proxies from closing an idle stream
+            yield b': keep-alive\n\n'
+            continue
+        yield b''.join(b'id: %d\nevent: change\ndata: %s\n' % (seq, dump_care_request_line(care_request))
+                       for seq, care_request in convert_care_request_changes(changes, model))
+        cursor = changes[-1][0]
+
 
+def build_care_request_params(last_status_change_since: Optional[datetime.datetime],
+                              last_status_change_until: Optional[datetime.datetime],
+                              status: Optional[List[RequestStatus]],
+                              care_status: Optional[List[CareStatus]],
+                              symptoms_level: Optional[List[SymptomsLevel]],
+                              model: Type[BaseModel] = CareRequest) -> list:
     filter_by_formulas = []
 
     if last_status_change_since:
@@ -99,167 +219,260 @@ async def read_requests(last_status_change_since: Optional[datetime.datetime] =
             f"{build_airtable_datetime_expression(last_status_change_until, TIMEZONE)}) < 0")
 
     if status and len(status) > 0:
-        filter_by_formulas.append(build_airtable_formula_chain('OR', list(
-            map(lambda status: f"{{Status}}=\"{status}\"", status))))
+        filter_by_formulas.append(build_airtable_formula_chain('OR', [
+            build_airtable_match_expression('Status', value.value) for value in status]))
 
     if care_status and len(care_status) > 0:
-        filter_by_formulas.append(build_airtable_formula_chain('OR', list(
-            map(lambda care_status: f"{{Care Status}}=\"{care_status}\"", care_status))))
+        filter_by_formulas.append(build_airtable_formula_chain('OR', [
+            build_airtable_match_expression('Care Status', value.value) for value in care_status]))
 
     if symptoms_level and len(symptoms_level) > 0:
-        filter_by_formulas.append(build_airtable_formula_chain('OR', list(
-            map(lambda symptoms_level: f"{{Symptoms Level}}=\"{symptoms_level}\"", symptoms_level))))
+        filter_by_formulas.append(build_airtable_formula_chain('OR', [
+            build_airtable_match_expression('Symptoms Level', value.value) for value in symptoms_level]))
 
-    params = {
-        'pageSize': 100,
-    }
+    params = [
+        ('pageSize', 100),
+    ]
 
-    if len(filter_by_formulas) > 0:
-        params['filterByFormula'] = build_airtable_formula_chain('AND', filter_by_formulas)
+    # Airtable only sends the columns a projected response is built from
+    if model is not CareRequest:
+        params += [('fields[]', airtable_field) for airtable_field in get_airtable_fields(model)]
 
-    records = get_airtable_records(params)
+    if len(filter_by_formulas) > 0:
+        params.append(('filterByFormula', build_airtable_formula_chain('AND', filter_by_formulas)))
 
-    response_data = []
+    return params
 
-    for record in records:
-        fields = record.get('fields', [])
-        try:
-            response_data.append(CareRequest(
-                citizen_id=fields.get('Citizen ID').replace("-", "") if fields.get('Citizen ID') else None,
-                first_name=fields.get('First Name'),
-                last_name=fields.get('Last Name'),
-                phone_number=phonenumbers.format_number(phonenumbers.parse(
-                    fields.get('Phone Number'), "TH"), phonenumbers.PhoneNumberFormat.E164),
-                email=fields.get('Email'),
-                sex=fields.get('Sex'),
-                date_of_birth=fields.get(
-                    'Date of Birth') if fields.get('Date of Birth') else None,
-                status=fields.get('Status'),
-                street_address=fields.get('Street Address'),
-                subdistrict=fields.get('Subdistrict'),
-                district=fields.get('District'),
-                province=fields.get('Province'),
-                postal_code=fields.get('Postal Code'),
-                request_datetime=datetime.datetime.fromisoformat(
-                    f"{fields.get('Request Datetime')[:-1]}+00:00").astimezone(TIMEZONE),
-                channel=CHANNEL_NAME,
-                covid_test_document_image_url=fields.get('Covid Test Document Image')[0].get(
-                    'url') if fields.get('Covid Test Document Image') else None,
-                covid_test_location_type=fields.get('Covid Test Location Type'),
-                covid_test_location_name=fields.get('Covid Test Location Name'),
-                covid_test_date=fields.get(
-                    'Covid Test Date') if fields.get('Covid Test Date') else None,
-                covid_test_confirmation_date=fields.get(
-                    'Covid Test Confirmation Date') if fields.get('Covid Test Confirmation Date') else None,
-                symptoms=fields.get('Symptoms', []),
-                symptoms_level=fields.get('Symptoms Level'),
-                other_symptoms=fields.get('Other Symptoms'),
-                care_status=fields.get('Care Status'),
-                care_provider_name=fields.get('Care Provider Name'),
-                last_care_status_change_datetime=datetime.datetime.fromisoformat(
-                    f"{fields.get('Last Care Status Change Datetime')[:-1]}+00:00").astimezone(
-                    TIMEZONE) if fields.get('Last Care Status Change Datetime') else None,
-                location_latitude=fields.get('Location Latitude'),
-                location_longitude=fields.get('Location Longitude'),
-                caretaker_first_name=fields.get('Caretaker First Name'),
-                caretaker_last_name=fields.get('Caretaker Last Name'),
-                caretaker_email=fields.get('Caretaker Email'),
-                caretaker_phone_number=phonenumbers.format_number(phonenumbers.parse(
-                    fields.get('Caretaker Phone Number'), "TH"), phonenumbers.PhoneNumberFormat.E164),
-                caretaker_relationship=fields.get('Caretaker Relationship'),
-                checker=fields.get('Checker'),
-                note=fields.get('Note'),
-                last_status_change_datetime=datetime.datetime.fromisoformat(
-                    f"{fields.get('Last Status Change Datetime')[:-1]}+00:00").astimezone(
-                    TIMEZONE) if fields.get('Last Status Change Datetime') else None
-            ))
-        except ValidationError as e:
-            logging.error(
-                'A record was dropped due to a Validation error', exc_info=e)
-        except AttributeError as e:
-            logging.error('A record was dropped due to an Attribute error', exc_info=e)
-        except phonenumbers.NumberParseException as e:
-            logging.error('A record was dropped due to an NumberParse exception', exc_info=e)
-
-    if len(records) - len(response_data) > 0:
-        logging.warn(
-            f"A total of {len(records) - len(response_data)} was unable to be created.")
-    return {
-        'data': response_data
-    }
 
+def build_care_request_cache_key(last_status_change_since: Optional[datetime.datetime],
+                                 last_status_change_until: Optional[datetime.datetime],
+                                 status: Optional[List[RequestStatus]],
+                                 care_status: Optional[List[CareStatus]],
+                                 symptoms_level: Optional[List[SymptomsLevel]],
+                                 fields: Optional[List[CareRequestField]]) -> tuple:
+    def normalise_datetime(_datetime: Optional[datetime.datetime]) -> Optional[str]:
+        if _datetime is None:
+            return None
+        if _datetime.tzinfo is None or _datetime.tzinfo.utcoffset(_datetime) is None:
+            _datetime = _datetime.replace(tzinfo=TIMEZONE)
+        return _datetime.astimezone(datetime.timezone.utc).isoformat()
 
-@app.post("/care_provided_report")
-def report_provided_care(care_provided_report: List[CareProvidedReport], api_key: APIKey = Depends(get_api_key)):
-    reports = [] + care_provided_report
+    def normalise_values(values: Optional[list]) -> tuple:
+        return tuple(sorted(set(value.value for value in values))) if values else ()
 
-    matched_records = get_citizen_id_matched_airtable_records([report.citizen_id for report in reports])
+    return (normalise_datetime(last_status_change_since), normalise_datetime(last_status_change_until),
+            normalise_values(status), normalise_values(care_status), normalise_values(symptoms_level),
+            normalise_values(fields))
 
-    records_to_be_updated = []
-    skipped_reports = []
-    updated_reports = []
 
-    for report in care_provided_report:
-        citizen_id = hyphenate_citizen_id(report.citizen_id)
-        care_provider_name = report.care_provider_name
-        id_matched_records = list(filter(lambda record: record.get(
-            'fields').get('Citizen ID') == citizen_id, matched_records))
+@app.get("/requests", response_model=CareRequestResponse)
+async def read_requests(last_status_change_since: Optional[datetime.datetime] = Query(None),
+                        last_status_change_until: Optional[datetime.datetime] = Query(None),
+                        status: Optional[List[RequestStatus]] = Query(None),
+                        care_status: Optional[List[CareStatus]] = Query(None),
+                        symptoms_level: Optional[List[SymptomsLevel]] = Query(None),
+                        format: ResponseFormat = Query(ResponseFormat.JSON),
+                        fields: Optional[List[CareRequestField]] = Query(None),
+                        if_none_match: Optional[str] = Header(None),
+                        if_modified_since: Optional[str] = Header(None),
+                        api_key: APIKey = Depends(get_api_key)):
 
-        if len(list(filter(lambda rp: rp.citizen_id == report.citizen_id, care_provided_report))) != 1:
-            skipped_reports.append(report.dict())
-            continue
-        if len(id_matched_records) == 1:
-            updated_reports.append(report.dict())
+    model = get_care_request_model(frozenset(field.value for field in fields)) if fields else CareRequest
+    query_key = repr(build_care_request_cache_key(last_status_change_since, last_status_change_until, status,
+                                                  care_status, symptoms_level, fields)).encode()
+    replica_fresh = is_replica_fresh()
+    headers = {}
+
+    if replica_fresh:
+        synced_at = get_replica_synced_at()
+        headers['Age'] = str(max(0, int(time.time() - synced_at)))
+        headers['X-Replica-Synced-At'] = datetime.datetime.fromtimestamp(synced_at, TIMEZONE).isoformat()
+        # Any change to the replica moves modified_at, so an unchanged query is answered without reading it
+        modified_at = get_replica_modified_at()
+        headers['ETag'] = build_etag(query_key, format.value.encode(), repr(modified_at).encode())
+        headers['Last-Modified'] = formatdate(modified_at, usegmt=True)
+        if is_not_modified(if_none_match, if_modified_since, headers['ETag'], modified_at):
+            return Response(status_code=HTTP_304_NOT_MODIFIED, headers=headers)
+
+    if format == ResponseFormat.NDJSON:
+        if replica_fresh:
+            pages = iterate_in_threadpool(iter_replica_record_pages(
+                last_status_change_since, last_status_change_until, status, care_status, symptoms_level, TIMEZONE))
         else:
-            skipped_reports.append(report.dict())
-
-        for record in id_matched_records:
-            fields = record.get('fields')
-            # Skip updating record with no changes
-            if not (fields.get('Care Status') == 'PROVIDED' and
-                    fields.get('Care Provider Name', '') == care_provider_name):
-                records_to_be_updated.append({
-                    'id': record.get('id'),
-                    'fields': {
-                        'Care Status': 'PROVIDED',
-                        'Care Provider Name': (care_provider_name if care_provider_name
-                                               else fields.get('Care Provider Name', '')),
-                        'Note': (
-                            record.get('fields').get('Note', '') +
-                            f"\n\nUpdated care status to PROVIDED by {care_provider_name} via API-SHIM on " +
-                            f"{datetime.datetime.now().astimezone(TIMEZONE).isoformat()}"
-                        )
-                    }
-                })
-
-    retry_count = 0
-    skipped_count = 0
-    updated_records = []
-
-    for i in range(0, len(records_to_be_updated), 10):
-        time.sleep(AIRTABLE_REQUEST_DELAY)
-        working_records = records_to_be_updated[i:i + 10]
-
-        if retry_count > 5:
-            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-                                detail="Unable to reach backend, possible case of partial update, please retry.")
-
-        response = requests.patch(AIRTABLE_BASE_URL, headers=AIRTABLE_AUTH_HEADER,
-                                  json={'records': working_records})
-
-        if response.status_code != requests.codes.OK:
-            retry_count += 1
-            i -= 10
+            pages = iter_airtable_scan_pages(build_care_request_params(
+                last_status_change_since, last_status_change_until, status, care_status, symptoms_level, model))
+        return StreamingResponse(stream_care_requests(pages, model), media_type='application/x-ndjson',
+                                 headers=headers)
+
+    if replica_fresh:
+        with requests_stage_seconds.time(stage='replica'):
+            records = await run_in_threadpool(
+                query_replica_records,
+                last_status_change_since, last_status_change_until, status, care_status, symptoms_level, TIMEZONE)
+        body, record_count = serialise_care_requests(records, model)
+    else:
+        params = build_care_request_params(
+            last_status_change_since, last_status_change_until, status, care_status, symptoms_level, model)
+
+        async def fetch_airtable_records(wait_for_rate_limit: bool = True) -> List:
+            with requests_stage_seconds.time(stage='airtable'):
+                records = await get_airtable_records(params, partitioned=True, wait_for_rate_limit=wait_for_rate_limit)
+            # Projected records lack the fields the citizen index keeps
+            if is_citizen_index_enabled() and model is CareRequest:
+                index_records(records)
+            return records
+
+        # Airtable has no cheap change check, but hashing the raw records costs far less than converting and
+        # serialising them. Nothing tells when the records last changed either, so Last-Modified is when they were
+        # read, which is never earlier than the change
+        async def fetch_care_requests(wait_for_rate_limit: bool = True) -> Tuple[bytes, int, str, float]:
+            fetched_at = time.time()
+            records = await fetch_airtable_records(wait_for_rate_limit)
+            return serialise_care_requests(records, model) + (build_etag(query_key, orjson.dumps(records)), fetched_at)
+
+        # The cache keeps the serialised response, so cache hits cost no conversion or encoding. An expired entry is
+        # served as soon as Airtable rate limits its refresh, which then waits out the limit in the background.
+        if REQUESTS_CACHE_TTL > 0:
+            (body, record_count, headers['ETag'], fetched_at), headers['X-Cache'] = await requests_cache.get_or_fetch(
+                query_key, fetch_care_requests, lambda: fetch_care_requests(wait_for_rate_limit=False))
+            headers['Last-Modified'] = formatdate(fetched_at, usegmt=True)
+            if is_not_modified(if_none_match, if_modified_since, headers['ETag'], fetched_at):
+                return Response(status_code=HTTP_304_NOT_MODIFIED, headers=headers)
         else:
-            retry_count = 0
-            updated_records += working_records
+            fetched_at = time.time()
+            records = await fetch_airtable_records()
+            headers['ETag'] = build_etag(query_key, orjson.dumps(records))
+            headers['Last-Modified'] = formatdate(fetched_at, usegmt=True)
+            if is_not_modified(if_none_match, if_modified_since, headers['ETag'], fetched_at):
+                return Response(status_code=HTTP_304_NOT_MODIFIED, headers=headers)
+            body, record_count = serialise_care_requests(records, model)
+
+    requests_records.observe(record_count)
+    # A ready Response is sent as is, FastAPI does not validate and encode the care requests against the
+    # response_model a second time
+    return Response(body, media_type='application/json', headers=headers)
+
+
+@app.get("/requests/changes", response_model=CareRequestChangesResponse)
+async def read_request_changes(request: Request,
+                               cursor: Optional[int] = Query(None, ge=0),
+                               timeout: float = Query(30, ge=0, le=CHANGES_MAX_WAIT),
+                               fields: Optional[List[CareRequestField]] = Query(None),
+                               accept: Optional[str] = Header(None),
+                               last_event_id: Optional[int] = Header(None),
+                               api_key: APIKey = Depends(get_api_key)):
+
+    model = get_care_request_model(frozenset(field.value for field in fields)) if fields else CareRequest
+    # EventSource sends the id of the last event it received when it reconnects
+    if last_event_id is not None:
+        cursor = last_event_id
+    # Without a cursor the feed starts from now, the current state comes from /requests
+    if cursor is None:
+        cursor = get_changes_head()
+    elif is_cursor_expired(cursor):
+        raise HTTPException(status_code=status.HTTP_410_GONE,
+                            detail="The cursor is older than the change log, re-read /requests and start over")
+
+    if accept and 'text/event-stream' in accept:
+        return StreamingResponse(stream_care_request_changes(request, cursor, model),
+                                 media_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+    changes = await wait_for_care_request_changes(cursor, timeout)
+    care_requests = convert_care_request_changes(changes, model)
+    if len(changes) > 0:
+        cursor = changes[-1][0]
+    return Response(dump_care_request_response([care_request for _, care_request in care_requests], cursor=cursor),
+                    media_type='application/json')
+
+
+@app.get("/exports")
+async def read_exports(api_key: APIKey = Depends(get_api_key)):
+    return read_export_manifest()
+
+
+@app.get("/exports/{name}")
+async def read_export(name: str,
+                      range_header: Optional[str] = Header(None, alias='Range'),
+                      if_range: Optional[str] = Header(None),
+                      api_key: APIKey = Depends(get_api_key)):
+    path = get_export_path(name)
+    if not is_export_file_name(name) or not os.path.exists(path):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Export not found")
+
+    size = os.path.getsize(path)
+    # Export files never change once written, so their name identifies their content
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'ETag': f'"{name}"',
+        'Content-Disposition': f'attachment; filename="{name}"',
+    }
+    first, last = 0, size - 1
+    status_code = status.HTTP_200_OK
+
+    if range_header and (not if_range or if_range == headers['ETag']):
+        try:
+            byte_range = parse_byte_range(range_header, size)
+        except ValueError:
+            raise HTTPException(status_code=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE,
+                                detail="Requested range not satisfiable", headers={'Content-Range': f'bytes */{size}'})
+        if byte_range is not None:
+            first, last = byte_range
+            status_code = status.HTTP_206_PARTIAL_CONTENT
+            headers['Content-Range'] = f'bytes {first}-{last}/{size}'
+
+    headers['Content-Length'] = str(last - first + 1)
+    return StreamingResponse(iterate_in_threadpool(iter_export_file_range(name, first, last)), status_code=status_code,
+                             media_type='application/gzip', headers=headers)
 
-    logging.info(f'{len(updated_records)} records updated on Airtable.')
 
-    if skipped_count > 0:
-        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-                            detail="Unable to reach backend, possible case of partial update, please retry.")
+@app.get("/profiles", include_in_schema=False)
+async def read_profiles(api_key: APIKey = Depends(get_admin_api_key)):
+    return list_profiles()
 
-    return JSONResponse(content={'skipped': skipped_reports, 'updated': updated_reports},
-                        status_code=status.HTTP_200_OK if len(skipped_reports) == 0
-                        else status.HTTP_207_MULTI_STATUS)
+
+@app.get("/profiles/{name}", include_in_schema=False)
+async def read_profile(name: str, summary: bool = Query(False), api_key: APIKey = Depends(get_admin_api_key)):
+    path = get_profile_path(name)
+    if not is_profile_file_name(name) or not os.path.exists(path):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Profile not found")
+    # The summary is the top of the profile by cumulative time, the file itself loads with pstats or snakeviz
+    if summary:
+        return PlainTextResponse(await run_in_threadpool(render_profile_summary, name))
+    return FileResponse(path, media_type='application/octet-stream', filename=name)
+
+
+@app.get("/metrics", include_in_schema=False)
+async def read_metrics(api_key: APIKey = Depends(get_api_key)):
+    return PlainTextResponse(render_metrics(), media_type='text/plain; version=0.0.4')
+
+
+@app.post("/care_provided_report")
+async def report_provided_care(care_provided_report: List[CareProvidedReport],
+                               run_as_job: bool = Query(False),
+                               write_behind: bool = Query(False),
+                               api_key: APIKey = Depends(get_api_key)):
+    if write_behind:
+        queued = await run_in_threadpool(enqueue_care_status_updates, care_provided_report)
+        return JSONResponse(content={'queued': queued, 'status_url': '/care_provided_report/queue'},
+                            status_code=status.HTTP_202_ACCEPTED)
+
+    if run_as_job:
+        job_id = await enqueue_care_provided_report_job(care_provided_report)
+        return JSONResponse(content={'id': job_id, 'status_url': f'/care_provided_report/jobs/{job_id}'},
+                            status_code=status.HTTP_202_ACCEPTED)
+
+    content, status_code = await process_care_provided_report(care_provided_report)
+    return JSONResponse(content=content, status_code=status_code)
+
+
+@app.get("/care_provided_report/queue")
+async def read_care_status_update_queue(api_key: APIKey = Depends(get_api_key)):
+    return get_update_queue_status()
+
+
+@app.get("/care_provided_report/jobs/{job_id}")
+async def read_care_provided_report_job(job_id: str, api_key: APIKey = Depends(get_api_key)):
+    job = get_care_provided_report_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job not found")
+    return job
@@ -0,0 +1,274 @@
+import abc
+import asyncio
+import bisect
+import fcntl
+import glob
+import json
+import logging
+import os
+import tempfile
+import time
+from collections import defaultdict
+from contextlib import contextmanager, suppress
+from typing import Dict, List, Optional, Tuple
+
+import dotenv
+from starlette.routing import Match
+
+dotenv.load_dotenv()
+
+# Every process (each gunicorn worker and the CMC poller) writes its metrics to its own file in this directory,
+# and /metrics adds them all up
+METRICS_DIRECTORY = os.environ.get('METRICS_DIRECTORY', os.path.join(tempfile.gettempdir(),
+                                                                     'bkkcovid19connect-metrics'))
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SIZE_BUCKETS = (0, 1, 10, 100, 1000, 5000, 10000, 50000, 100000)
+
+_metrics: Dict[str, 'Metric'] = {}
+_dirty = False
+_metrics_lock_pid: Optional[int] = None
+
+
+def _label_key(labels: dict) -> str:
+    return json.dumps(sorted(labels.items()))
+
+
+def _escape_label_value(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(label_key: str, extra: Tuple = ()) -> str:
+    labels = [tuple(label) for label in json.loads(label_key)] + list(extra)
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape_label_value(value)}"' for name, value in labels) + '}'
+
+
+class Metric(abc.ABC):
+    kind = ''
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self.values = {}
+        _metrics[name] = self
+
+    @abc.abstractmethod
+    def merge(self, merged: dict, values: dict):
+        pass
+
+    @abc.abstractmethod
+    def render(self, values: dict) -> List[str]:
+        pass
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        global _dirty
+        key = _label_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+        _dirty = True
+
+    def merge(self, merged: dict, values: dict):
+        for key, value in values.items():
+            merged[key] = merged.get(key, 0) + value
+
+    def render(self, values: dict) -> List[str]:
+        return [f'{self.name}{_format_labels(key)} {value}' for key, value in sorted(values.items())]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, buckets: Tuple = LATENCY_BUCKETS):
+        super().__init__(name, documentation)
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels):
+        global _dirty
+        key = _label_key(labels)
+        # Per-bucket (not cumulative) counts followed by the sum
+        entry = self.values.get(key)
+        if entry is None:
+            entry = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        entry[bisect.bisect_left(self.buckets, value)] += 1
+        entry[-1] += value
+        _dirty = True
+
+    @contextmanager
+    def time(self, **labels):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, **labels)
+
+    def merge(self, merged: dict, values: dict):
+        for key, entry in values.items():
+            if key in merged:
+                merged[key] = [a + b for a, b in zip(merged[key], entry)]
+            else:
+                merged[key] = list(entry)
+
+    def render(self, values: dict) -> List[str]:
+        lines = []
+        for key, entry in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), entry[:-1]):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_format_labels(key, (("le", str(bound)),))} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(key)} {entry[-1]}')
+            lines.append(f'{self.name}_count{_format_labels(key)} {cumulative}')
+        return lines
+
+
+http_request_duration_seconds = Histogram(
+    'http_request_duration_seconds', 'Time from receiving a request to sending the last byte of its response')
+requests_stage_seconds = Histogram(
+    'requests_stage_seconds', 'Time spent in each stage of serving /requests')
+requests_records = Histogram(
+    'requests_records', 'Care requests returned per /requests call', SIZE_BUCKETS)
+dropped_records_total = Counter(
+    'dropped_records_total', 'Airtable records that could not be converted to care requests, by reason')
+airtable_requests_total = Counter(
+    'airtable_requests_total', 'Requests made to Airtable, by method and response status')
+airtable_request_seconds = Histogram(
+    'airtable_request_seconds', 'Duration of Airtable requests, excluding the rate limit queue')
+airtable_rate_limit_wait_seconds = Histogram(
+    'airtable_rate_limit_wait_seconds', 'Time Airtable requests waited in the shared rate limit queue')
+cache_requests_total = Counter(
+    'cache_requests_total', 'Response cache lookups, by cache and result (HIT, MISS, COALESCED or STALE)')
+care_status_updates_total = Counter(
+    'care_status_updates_total', 'Care status updates through the write-behind queue, by result')
+cmc_requests_total = Counter(
+    'cmc_requests_total', 'Requests made to the CMC API, by response status')
+cmc_poll_seconds = Histogram(
+    'cmc_poll_seconds', 'Duration of each CMC poll phase (fetch and diff, update)')
+cmc_poll_failures_total = Counter(
+    'cmc_poll_failures_total', 'CMC polls that raised an error')
+cmc_rows_total = Counter(
+    'cmc_rows_total', 'CMC rows seen by the poller, by whether they were new, changed, unchanged or retried')
+
+
+def get_metrics_path() -> str:
+    return os.path.join(METRICS_DIRECTORY, f'{os.getpid()}.json')
+
+
+def get_metrics_lock_path(metrics_path: str) -> str:
+    return f'{os.path.splitext(metrics_path)[0]}.lock'
+
+
+def hold_metrics_lock():
+    global _metrics_lock_pid
+    if _metrics_lock_pid == os.getpid():
+        return
+    # Held until the process exits, which tells /metrics that the metrics file still belongs to a live process
+    fd = os.open(get_metrics_lock_path(get_metrics_path()), os.O_RDWR | os.O_CREAT, 0o666)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    _metrics_lock_pid = os.getpid()
+
+
+def is_metrics_process_alive(metrics_path: str) -> bool:
+    try:
+        fd = os.open(get_metrics_lock_path(metrics_path), os.O_RDWR)
+    except FileNotFoundError:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return True
+    finally:
+        os.close(fd)
+    return False
+
+
+def flush_metrics():
+    global _dirty
+    if not _dirty:
+        return
+    _dirty = False
+    os.makedirs(METRICS_DIRECTORY, exist_ok=True)
+    hold_metrics_lock()
+    path = get_metrics_path()
+    temporary_path = f'{path}.tmp'
+    with open(temporary_path, 'w') as f:
+        json.dump({name: metric.values for name, metric in _metrics.items()}, f)
+    os.replace(temporary_path, path)
+
+
+async def run_metrics_flush():
+    while True:
+        await asyncio.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            flush_metrics()
+        except OSError as e:
+            logging.error('Unable to write metrics', exc_info=e)
+
+
+def render_metrics() -> str:
+    flush_metrics()
+    merged = defaultdict(dict)
+    for path in glob.glob(os.path.join(METRICS_DIRECTORY, '*.json')):
+        # Files left by exited processes are dropped, rather than counted forever or taken over by a reused PID
+        if not is_metrics_process_alive(path):
+            for dead_path in (path, get_metrics_lock_path(path)):
+                with suppress(FileNotFoundError):
+                    os.remove(dead_path)
+            continue
+        try:
+            with open(path) as f:
+                process_values = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for name, values in process_values.items():
+            if name in _metrics:
+                _metrics[name].merge(merged[name], values)
+
+    lines = []
+    for name, metric in _metrics.items():
+        lines.append(f'# HELP {name} {metric.documentation}')
+        lines.append(f'# TYPE {name} {metric.kind}')
+        lines += metric.render(merged[name])
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    def get_route_path(self, scope) -> str:
+        for route in scope['app'].router.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route.path
+        return 'unmatched'
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        started_at = time.perf_counter()
+        status_code = 500
+
+        async def send_and_measure(message):
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+            if message['type'] == 'http.response.body' and not message.get('more_body', False):
+                http_request_duration_seconds.observe(
+                    time.perf_counter() - started_at, method=scope['method'], route=self.get_route_path(scope),
+                    status=status_code)
+
+        try:
+            await self.app(scope, receive, send_and_measure)
+        except Exception:
+            http_request_duration_seconds.observe(
+                time.perf_counter() - started_at, method=scope['method'], route=self.get_route_path(scope),
+                status=500)
+            raise
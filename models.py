@@ -2,9 +2,10 @@
 import datetime
 import decimal
 from enum import Enum
-from typing import List, Optional
+from functools import lru_cache
+from typing import FrozenSet, List, Optional, Type
 
-from pydantic import BaseModel, EmailStr, Field, HttpUrl, constr
+from pydantic import BaseModel, EmailStr, Field, HttpUrl, constr, create_model
 
 
 class Channel(str, Enum):
@@ -51,6 +52,11 @@ class SymptomsLevel(str, Enum):
     GREEN = "GREEN"
 
 
+class ResponseFormat(str, Enum):
+    JSON = "json"
+    NDJSON = "ndjson"
+
+
 class CareRequest(BaseModel):
     citizen_id: constr(regex=r'^\d{13}$')
     first_name: str
@@ -119,6 +125,25 @@ class CareRequestResponse(BaseModel):
     data: List[CareRequest]
 
 
+class CareRequestChangesResponse(BaseModel):
+    data: List[CareRequest]
+    cursor: int
+
+
+CareRequestField = Enum('CareRequestField', {name: name for name in CareRequest.__fields__}, type=str)
+
+
+@lru_cache(maxsize=128)
+def get_care_request_model(field_names: FrozenSet[str]) -> Type[BaseModel]:
+    # A CareRequest with only the given fields, in CareRequest field order
+    if field_names >= set(CareRequest.__fields__):
+        return CareRequest
+    return create_model('PartialCareRequest', **{
+        name: (field.outer_type_, Field(..., description=field.field_info.description)) if field.required
+        else (Optional[field.outer_type_], None)
+        for name, field in CareRequest.__fields__.items() if name in field_names})
+
+
 class CareProvidedReport(BaseModel):
     citizen_id: constr(regex=r'^\d{13}$')
     care_provider_name: str
@@ -0,0 +1,126 @@
+import cProfile
+import datetime
+import io
+import logging
+import os
+import pstats
+import re
+import time
+import uuid
+from typing import List, Optional
+
+import dotenv
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+
+from security import API_KEY_NAME, is_admin_api_key
+from utils import DATA_DIRECTORY
+
+dotenv.load_dotenv()
+
+PROFILES_DIRECTORY = os.environ.get('PROFILES_DIRECTORY', os.path.join(DATA_DIRECTORY, 'profiles'))
+PROFILES_KEEP = int(os.environ.get('PROFILES_KEEP', 20))
+PROFILE_SUMMARY_LIMIT = 60
+PROFILE_FILE_NAME_PATTERN = re.compile(r'^profile-[0-9TZ]+-[0-9a-f]{8}\.prof$')
+
+# cProfile hooks the whole thread, so a profile also holds whatever other requests the worker serves meanwhile,
+# and only one can be captured at a time
+_active_profile_name: Optional[str] = None
+
+
+def is_profile_file_name(name: str) -> bool:
+    return PROFILE_FILE_NAME_PATTERN.match(name) is not None
+
+
+def get_profile_path(name: str) -> str:
+    return os.path.join(PROFILES_DIRECTORY, name)
+
+
+def list_profiles() -> List[dict]:
+    if not os.path.isdir(PROFILES_DIRECTORY):
+        return []
+    return [{
+        'name': name,
+        'size': os.path.getsize(get_profile_path(name)),
+        'url': f'/profiles/{name}',
+    } for name in sorted(filter(is_profile_file_name, os.listdir(PROFILES_DIRECTORY)), reverse=True)]
+
+
+def render_profile_summary(name: str) -> str:
+    stream = io.StringIO()
+    pstats.Stats(get_profile_path(name), stream=stream).sort_stats('cumulative').print_stats(PROFILE_SUMMARY_LIMIT)
+    return stream.getvalue()
+
+
+def save_profile(profiler: cProfile.Profile, name: str):
+    os.makedirs(PROFILES_DIRECTORY, exist_ok=True)
+    path = get_profile_path(name)
+    profiler.dump_stats(f'{path}.tmp')
+    os.replace(f'{path}.tmp', path)
+    for expired in list_profiles()[PROFILES_KEEP:]:
+        os.remove(get_profile_path(expired['name']))
+
+
+def build_profile_name() -> str:
+    started_at = datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%S%fZ')
+    return f'profile-{started_at}-{uuid.uuid4().hex[:8]}.prof'
+
+
+class ProfilingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        global _active_profile_name
+        # Requests without profile= in their query string pay for this check only
+        if scope['type'] != 'http' or b'profile=' not in scope.get('query_string', b''):
+            await self.app(scope, receive, send)
+            return
+
+        request = Request(scope)
+        if request.query_params.get('profile', '').lower() not in ('1', 'true'):
+            await self.app(scope, receive, send)
+            return
+        if not is_admin_api_key(request.cookies.get(API_KEY_NAME), request.headers.get(API_KEY_NAME),
+                                request.query_params.get(API_KEY_NAME)):
+            response = JSONResponse({'detail': 'Profiling requires an admin API key'}, status_code=403)
+            await response(scope, receive, send)
+            return
+        if _active_profile_name is not None:
+            response = JSONResponse({'detail': f'Already profiling into {_active_profile_name}'}, status_code=409)
+            await response(scope, receive, send)
+            return
+
+        name = build_profile_name()
+        profiler = cProfile.Profile()
+        started_at = time.perf_counter()
+
+        def finish_profile():
+            global _active_profile_name
+            if _active_profile_name != name:
+                return
+            profiler.disable()
+            _active_profile_name = None
+            try:
+                save_profile(profiler, name)
+            except OSError as e:
+                logging.error(f'Unable to save profile {name}', exc_info=e)
+                return
+            logging.info(f"Profiled {scope['method']} {scope['path']} into {name} in " +
+                         f'{time.perf_counter() - started_at:.3f}s.')
+
+        async def send_and_profile(message):
+            if message['type'] == 'http.response.start':
+                message['headers'] = list(message.get('headers', [])) + [
+                    (b'x-profile-url', f'/profiles/{name}'.encode())]
+            elif message['type'] == 'http.response.body' and not message.get('more_body', False):
+                # Saved before the last chunk goes out, so the profile can be downloaded once the response is read
+                finish_profile()
+            await send(message)
+
+        _active_profile_name = name
+        profiler.enable()
+        try:
+            await self.app(scope, receive, send_and_profile)
+        finally:
+            finish_profile()
@@ -0,0 +1,84 @@
+import asyncio
+import fcntl
+import os
+import struct
+import tempfile
+import time
+from typing import Tuple
+
+import dotenv
+
+dotenv.load_dotenv()
+
+# Airtable allows 5 requests per second per base, shared by every process talking to it
+AIRTABLE_RATE_LIMIT = float(os.environ.get('AIRTABLE_RATE_LIMIT', 5))
+AIRTABLE_RATE_LIMIT_BURST = float(os.environ.get('AIRTABLE_RATE_LIMIT_BURST', AIRTABLE_RATE_LIMIT))
+AIRTABLE_RATE_LIMIT_FILE = os.environ.get('AIRTABLE_RATE_LIMIT_FILE', os.path.join(
+    tempfile.gettempdir(), f"airtable-rate-limit-{os.environ.get('AIRTABLE_BASE_ID')}"))
+
+# Another process holds the state file's lock for microseconds at a time, so it is polled for rather than waited on,
+# which would stall every coroutine of the worker
+AIRTABLE_RATE_LIMIT_LOCK_POLL_INTERVAL = 0.001
+
+# tokens, last refill time, time until which every process must hold off (after a 429)
+_STATE_FORMAT = 'ddd'
+_STATE_SIZE = struct.calcsize(_STATE_FORMAT)
+
+
+class RateLimitBlockedError(Exception):
+    pass
+
+
+class SharedTokenBucket:
+    def __init__(self, path: str, rate: float, capacity: float):
+        self.path = path
+        self.rate = rate
+        self.capacity = capacity
+
+    async def _update(self, update):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    await asyncio.sleep(AIRTABLE_RATE_LIMIT_LOCK_POLL_INTERVAL)
+            data = os.pread(fd, _STATE_SIZE, 0)
+            now = time.time()
+            if len(data) == _STATE_SIZE:
+                tokens, updated_at, blocked_until = struct.unpack(_STATE_FORMAT, data)
+            else:
+                tokens, updated_at, blocked_until = self.capacity, now, 0.0
+            tokens = min(self.capacity, tokens + max(0.0, now - updated_at) * self.rate)
+            tokens, blocked_until, result = update(now, tokens, blocked_until)
+            os.pwrite(fd, struct.pack(_STATE_FORMAT, tokens, now, blocked_until), 0)
+            return result
+        finally:
+            os.close(fd)
+
+    async def _take(self) -> Tuple[float, bool]:
+        def take(now, tokens, blocked_until):
+            if now < blocked_until:
+                return tokens, blocked_until, (blocked_until - now, True)
+            if tokens >= 1:
+                return tokens - 1, blocked_until, (0.0, False)
+            return tokens, blocked_until, ((1 - tokens) / self.rate, False)
+
+        return await self._update(take)
+
+    async def acquire(self, wait_while_blocked: bool = True) -> float:
+        started_at = time.monotonic()
+        while True:
+            wait, blocked = await self._take()
+            if wait <= 0:
+                return time.monotonic() - started_at
+            if blocked and not wait_while_blocked:
+                raise RateLimitBlockedError(f'Rate limited for another {wait:.1f}s')
+            await asyncio.sleep(wait)
+
+    async def block_for(self, seconds: float):
+        await self._update(lambda now, tokens, blocked_until: (0.0, max(blocked_until, now + seconds), None))
+
+
+airtable_rate_limiter = SharedTokenBucket(AIRTABLE_RATE_LIMIT_FILE, AIRTABLE_RATE_LIMIT, AIRTABLE_RATE_LIMIT_BURST)
@@ -0,0 +1,251 @@
+import asyncio
+import datetime
+import json
+import logging
+import os
+import sqlite3
+import time
+from typing import Dict, Iterator, List, Optional
+
+import dotenv
+
+from airtable import (build_airtable_modified_since_formula,
+                      close_airtable_client, get_airtable_records,
+                      parse_airtable_timestamp)
+from utils import (UTC, build_in_clause, connect_sqlite, hyphenate_citizen_id,
+                   iter_chunks)
+
+dotenv.load_dotenv()
+
+# Replica mode is enabled by pointing REPLICA_DATABASE_PATH at the SQLite file kept up to date by `python replica.py`
+REPLICA_DATABASE_PATH = os.environ.get('REPLICA_DATABASE_PATH')
+REPLICA_SYNC_INTERVAL = int(os.environ.get('REPLICA_SYNC_INTERVAL', 60))
+# Incremental syncs cannot see deleted records, so the whole table is re-read every so often
+REPLICA_FULL_SYNC_INTERVAL = int(os.environ.get('REPLICA_FULL_SYNC_INTERVAL', 3600))
+# Older replicas are ignored and queries go to Airtable instead
+REPLICA_MAX_STALENESS = int(os.environ.get('REPLICA_MAX_STALENESS', 600))
+# Re-read records modified slightly before the last sync to cover clock skew between us and Airtable
+REPLICA_SYNC_OVERLAP = 60
+
+_replica_connection: Optional[sqlite3.Connection] = None
+
+
+def is_replica_enabled() -> bool:
+    return bool(REPLICA_DATABASE_PATH)
+
+
+def get_replica_connection() -> sqlite3.Connection:
+    global _replica_connection
+    if _replica_connection is None:
+        _replica_connection = connect_sqlite(REPLICA_DATABASE_PATH, '''
+            CREATE TABLE IF NOT EXISTS care_requests (
+                id TEXT PRIMARY KEY,
+                created_time TEXT,
+                citizen_id TEXT,
+                status TEXT,
+                care_status TEXT,
+                symptoms_level TEXT,
+                request_datetime REAL,
+                last_status_change_datetime REAL,
+                fields TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS care_requests_status ON care_requests (status);
+            CREATE INDEX IF NOT EXISTS care_requests_care_status ON care_requests (care_status);
+            CREATE INDEX IF NOT EXISTS care_requests_symptoms_level ON care_requests (symptoms_level);
+            CREATE INDEX IF NOT EXISTS care_requests_last_status_change_datetime
+                ON care_requests (last_status_change_datetime);
+            CREATE INDEX IF NOT EXISTS care_requests_citizen_id ON care_requests (citizen_id);
+            CREATE TABLE IF NOT EXISTS sync_state (
+                key TEXT PRIMARY KEY,
+                value REAL
+            );
+        ''')
+    return _replica_connection
+
+
+def to_replica_timestamp(value: Optional[str]) -> Optional[float]:
+    parsed = parse_airtable_timestamp(value)
+    return parsed.timestamp() if parsed is not None else None
+
+
+def to_timestamp(_datetime: datetime.datetime, timezone: datetime.timezone) -> float:
+    if _datetime.tzinfo is None or _datetime.tzinfo.utcoffset(_datetime) is None:
+        _datetime = _datetime.replace(tzinfo=timezone)
+    return _datetime.timestamp()
+
+
+def get_sync_state(key: str) -> Optional[float]:
+    row = get_replica_connection().execute('SELECT value FROM sync_state WHERE key = ?', (key,)).fetchone()
+    return row['value'] if row else None
+
+
+def get_replica_synced_at() -> Optional[float]:
+    return get_sync_state('synced_at')
+
+
+def get_replica_modified_at() -> Optional[float]:
+    # When the replicated data last changed, replicas synced before it was tracked fall back to their last sync
+    return get_sync_state('modified_at') or get_replica_synced_at()
+
+
+def is_replica_fresh() -> bool:
+    if not is_replica_enabled():
+        return False
+    synced_at = get_replica_synced_at()
+    return synced_at is not None and time.time() - synced_at <= REPLICA_MAX_STALENESS
+
+
+def count_changed_replica_records(connection: sqlite3.Connection, serialised_fields: Dict[str, str],
+                                  full: bool) -> int:
+    # A full sync replaces the whole table, so records missing from it count as changed (deleted) too
+    if full:
+        rows = connection.execute('SELECT id, fields FROM care_requests')
+    else:
+        ids = list(serialised_fields)
+        rows = (row for chunk in iter_chunks(ids)
+                for row in connection.execute('SELECT id, fields FROM care_requests WHERE ' +
+                                              build_in_clause('id', chunk)[0], chunk))
+    changed = 0
+    existing = 0
+    for row in rows:
+        fields = serialised_fields.get(row['id'])
+        if fields is not None:
+            existing += 1
+        if fields != row['fields']:
+            changed += 1
+    return changed + len(serialised_fields) - existing
+
+
+def _upsert_replica_records(connection: sqlite3.Connection, records: List, full: bool = False):
+    serialised_fields = {record['id']: json.dumps(record['fields']) for record in records}
+    # Syncs mostly re-read unchanged records, only actual changes move modified_at, which /requests uses as its
+    # Last-Modified time
+    if count_changed_replica_records(connection, serialised_fields, full) > 0 or get_sync_state('modified_at') is None:
+        connection.execute('INSERT OR REPLACE INTO sync_state VALUES (?, ?)', ('modified_at', time.time()))
+    if full:
+        connection.execute('DELETE FROM care_requests')
+    connection.executemany(
+        'INSERT OR REPLACE INTO care_requests VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        [(record['id'],
+          record.get('createdTime'),
+          record['fields'].get('Citizen ID'),
+          record['fields'].get('Status'),
+          record['fields'].get('Care Status'),
+          record['fields'].get('Symptoms Level'),
+          to_replica_timestamp(record['fields'].get('Request Datetime')),
+          to_replica_timestamp(record['fields'].get('Last Status Change Datetime')),
+          serialised_fields[record['id']]) for record in records])
+
+
+def upsert_replica_records(records: List):
+    connection = get_replica_connection()
+    with connection:
+        _upsert_replica_records(connection, records)
+
+
+def to_airtable_records(rows) -> List:
+    return [{'id': row['id'], 'createdTime': row['created_time'], 'fields': json.loads(row['fields'])}
+            for row in rows]
+
+
+def iter_replica_record_pages(last_status_change_since: Optional[datetime.datetime],
+                              last_status_change_until: Optional[datetime.datetime],
+                              status: Optional[List[str]],
+                              care_status: Optional[List[str]],
+                              symptoms_level: Optional[List[str]],
+                              timezone: datetime.timezone,
+                              page_size: int = 100) -> Iterator[List]:
+    conditions = []
+    args = []
+
+    if last_status_change_since:
+        conditions.append('last_status_change_datetime >= ?')
+        args.append(to_timestamp(last_status_change_since, timezone))
+
+    if last_status_change_until:
+        conditions.append('last_status_change_datetime < ?')
+        args.append(to_timestamp(last_status_change_until, timezone))
+
+    for column, values in (('status', status), ('care_status', care_status), ('symptoms_level', symptoms_level)):
+        if values and len(values) > 0:
+            condition, values = build_in_clause(column, [value.value for value in values])
+            conditions.append(condition)
+            args += values
+
+    where = f"WHERE {' AND '.join(conditions)}" if len(conditions) > 0 else ''
+    # Streamed pages are read in threadpool threads while upserts use the shared connection on the event loop, so
+    # every iteration reads through a connection of its own, which also keeps it on one WAL snapshot
+    connection = connect_sqlite(REPLICA_DATABASE_PATH)
+    try:
+        cursor = connection.execute(f'SELECT * FROM care_requests {where} ORDER BY created_time, id', args)
+        rows = cursor.fetchmany(page_size)
+        while rows:
+            yield to_airtable_records(rows)
+            rows = cursor.fetchmany(page_size)
+    finally:
+        connection.close()
+
+
+def query_replica_records(*args, **kwargs) -> List:
+    return [record for page in iter_replica_record_pages(*args, **kwargs) for record in page]
+
+
+def query_replica_citizen_id_matched_records(citizen_ids: List[str]) -> List:
+    hyphenated_citizen_ids = list(set(map(hyphenate_citizen_id, citizen_ids)))
+    matched_records = []
+
+    # Run in the threadpool, so like streamed pages it reads through a connection of its own
+    connection = connect_sqlite(REPLICA_DATABASE_PATH)
+    try:
+        for chunk in iter_chunks(hyphenated_citizen_ids):
+            condition, args = build_in_clause('citizen_id', chunk)
+            # Mirrors the filterByFormula of get_citizen_id_matched_airtable_records
+            matched_records += to_airtable_records(connection.execute(
+                f"SELECT * FROM care_requests WHERE {condition} AND status = 'FINISHED' AND request_datetime < ?",
+                args + [time.time() - 21]))
+    finally:
+        connection.close()
+
+    return sorted(matched_records, key=lambda record: record['fields'].get('Request Datetime', ''))
+
+
+async def sync_replica(full: bool = False):
+    connection = get_replica_connection()
+    started_at = time.time()
+    synced_at = get_replica_synced_at()
+    full = (full or synced_at is None or
+            started_at - (get_sync_state('full_synced_at') or 0) > REPLICA_FULL_SYNC_INTERVAL)
+
+    params = {'pageSize': 100}
+    if not full:
+        modified_since = datetime.datetime.fromtimestamp(synced_at - REPLICA_SYNC_OVERLAP, UTC)
+        params['filterByFormula'] = build_airtable_modified_since_formula(modified_since)
+
+    records = await get_airtable_records(params)
+
+    with connection:
+        _upsert_replica_records(connection, records, full)
+        connection.execute('INSERT OR REPLACE INTO sync_state VALUES (?, ?)', ('synced_at', started_at))
+        if full:
+            connection.execute('INSERT OR REPLACE INTO sync_state VALUES (?, ?)', ('full_synced_at', started_at))
+
+    logging.warn(f"Replica {'fully' if full else 'incrementally'} synced {len(records)} records " +
+                 f'in {time.time() - started_at:.1f}s.')
+
+
+async def run_replica_sync():
+    try:
+        while True:
+            try:
+                await sync_replica()
+            except Exception as e:
+                logging.error('Replica sync failed', exc_info=e)
+            await asyncio.sleep(REPLICA_SYNC_INTERVAL)
+    finally:
+        await close_airtable_client()
+
+
+if __name__ == '__main__':
+    if not is_replica_enabled():
+        raise EnvironmentError('REPLICA_DATABASE_PATH is not set')
+    asyncio.get_event_loop().run_until_complete(run_replica_sync())
@@ -1,4 +1,5 @@
 import os
+from typing import Optional
 
 import dotenv
 from fastapi import HTTPException, Security
@@ -12,6 +13,13 @@ TRUSTED_KEYS = []
 if os.environ.get('BMA_API_KEY'):
     TRUSTED_KEYS.append(os.environ.get('BMA_API_KEY'))
 
+# Admin keys can also profile requests and read the profiles, besides everything a trusted key can do
+ADMIN_KEYS = []
+
+if os.environ.get('ADMIN_API_KEY'):
+    ADMIN_KEYS.append(os.environ.get('ADMIN_API_KEY'))
+    TRUSTED_KEYS.append(os.environ.get('ADMIN_API_KEY'))
+
 API_KEY_NAME = 'token'
 
 api_key_query = APIKeyQuery(name=API_KEY_NAME, auto_error=False)
@@ -33,3 +41,19 @@ async def get_api_key(api_key_cookie: str = Security(api_key_cookie),
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid API Key",
         )
+
+
+def is_admin_api_key(*api_keys: Optional[str]) -> bool:
+    return any(api_key in ADMIN_KEYS for api_key in api_keys if api_key)
+
+
+async def get_admin_api_key(api_key_cookie: str = Security(api_key_cookie),
+                            api_key_header: str = Security(api_key_header),
+                            api_key_query: str = Security(api_key_query)):
+    for api_key in (api_key_cookie, api_key_header, api_key_query):
+        if is_admin_api_key(api_key):
+            return api_key
+    raise HTTPException(
+        status_code=status.HTTP_403_FORBIDDEN,
+        detail="Admin API key required",
+    )
@@ -0,0 +1,184 @@
+import asyncio
+import datetime
+import logging
+import os
+import sqlite3
+import time
+import uuid
+from typing import List, Optional
+
+import dotenv
+
+from airtable import AIRTABLE_PATCH_BATCH_SIZE
+from care_reports import process_care_provided_report
+from conversion import TIMEZONE
+from metrics import care_status_updates_total
+from models import CareProvidedReport
+from utils import DATA_DIRECTORY, connect_sqlite
+
+dotenv.load_dotenv()
+
+UPDATE_QUEUE_DATABASE_PATH = os.environ.get('UPDATE_QUEUE_DATABASE_PATH',
+                                            os.path.join(DATA_DIRECTORY, 'update_queue.sqlite3'))
+UPDATE_QUEUE_POLL_INTERVAL = float(os.environ.get('UPDATE_QUEUE_POLL_INTERVAL', 1))
+# Queued updates wait up to this long for enough others to fill a PATCH batch
+UPDATE_QUEUE_MAX_DELAY = float(os.environ.get('UPDATE_QUEUE_MAX_DELAY', 5))
+UPDATE_QUEUE_CLAIM_SIZE = int(os.environ.get('UPDATE_QUEUE_CLAIM_SIZE', 100))
+# Failed updates, and reports without a single matching care request (it may not have been created yet), are
+# retried with exponential backoff before they are given up on
+UPDATE_QUEUE_MAX_ATTEMPTS = int(os.environ.get('UPDATE_QUEUE_MAX_ATTEMPTS', 10))
+UPDATE_QUEUE_RETRY_BACKOFF = 30
+# A claim whose worker has not finished it for this long (e.g. the worker was restarted) is picked up again
+UPDATE_QUEUE_STALE_AFTER = 300
+
+UPDATE_PENDING = 'pending'
+UPDATE_FAILED = 'failed'
+
+CLAIMABLE_CONDITION = 'status = ? AND next_attempt_at <= ? AND (claim IS NULL OR claimed_at < ?)'
+
+_update_queue_connection: Optional[sqlite3.Connection] = None
+
+
+def get_update_queue_connection() -> sqlite3.Connection:
+    global _update_queue_connection
+    if _update_queue_connection is None:
+        # One row per citizen: a newer report replaces the queued one, under a new seq so that a flush already
+        # working on the old one cannot remove it
+        _update_queue_connection = connect_sqlite(UPDATE_QUEUE_DATABASE_PATH, '''
+            CREATE TABLE IF NOT EXISTS care_status_updates (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                citizen_id TEXT NOT NULL UNIQUE,
+                care_provider_name TEXT NOT NULL,
+                reported_at REAL NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                claim TEXT,
+                claimed_at REAL,
+                error TEXT
+            );
+            CREATE INDEX IF NOT EXISTS care_status_updates_status
+                ON care_status_updates (status, next_attempt_at);
+        ''')
+    return _update_queue_connection
+
+
+def enqueue_care_status_updates(care_provided_report: List[CareProvidedReport]) -> int:
+    # Within a report too, the last entry for a citizen wins
+    latest_reports = {report.citizen_id: report for report in care_provided_report}
+    now = time.time()
+    # Creates the table on first use
+    get_update_queue_connection()
+    # The API runs this in the threadpool, so it writes through a connection of its own rather than the one the
+    # flusher uses on the event loop
+    connection = connect_sqlite(UPDATE_QUEUE_DATABASE_PATH)
+    try:
+        with connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO care_status_updates ' +
+                '(citizen_id, care_provider_name, reported_at, status, next_attempt_at) VALUES (?, ?, ?, ?, ?)',
+                [(report.citizen_id, report.care_provider_name, now, UPDATE_PENDING, now)
+                 for report in latest_reports.values()])
+    finally:
+        connection.close()
+    care_status_updates_total.inc(len(latest_reports), result='queued')
+    return len(latest_reports)
+
+
+def get_update_queue_status() -> dict:
+    now = time.time()
+    rows = get_update_queue_connection().execute(
+        'SELECT status, COUNT(*) AS count, MIN(reported_at) AS oldest FROM care_status_updates GROUP BY status')
+    counts = {row['status']: row for row in rows}
+    pending = counts.get(UPDATE_PENDING)
+    return {
+        'pending': pending['count'] if pending else 0,
+        'failed': counts[UPDATE_FAILED]['count'] if UPDATE_FAILED in counts else 0,
+        'oldest_pending_seconds': now - pending['oldest'] if pending else None,
+    }
+
+
+def claim_care_status_updates() -> List[sqlite3.Row]:
+    claim = str(uuid.uuid4())
+    now = time.time()
+    args = (UPDATE_PENDING, now, now - UPDATE_QUEUE_STALE_AFTER)
+    connection = get_update_queue_connection()
+    with connection:
+        row = connection.execute('SELECT COUNT(*) AS count, MIN(reported_at) AS oldest FROM care_status_updates ' +
+                                 f'WHERE {CLAIMABLE_CONDITION}', args).fetchone()
+        # Only full PATCH batches are claimed, which saves requests when reports trickle in, until the oldest update
+        # has waited long enough for the rest to go out too
+        limit = min(row['count'], UPDATE_QUEUE_CLAIM_SIZE)
+        if row['count'] == 0 or now - row['oldest'] < UPDATE_QUEUE_MAX_DELAY:
+            limit = limit // AIRTABLE_PATCH_BATCH_SIZE * AIRTABLE_PATCH_BATCH_SIZE
+        if limit == 0:
+            return []
+        connection.execute(
+            'UPDATE care_status_updates SET claim = ?, claimed_at = ?, attempts = attempts + 1 ' +
+            f'WHERE seq IN (SELECT seq FROM care_status_updates WHERE {CLAIMABLE_CONDITION} ORDER BY seq LIMIT ?)',
+            (claim, now) + args + (limit,))
+    return connection.execute('SELECT * FROM care_status_updates WHERE claim = ?', (claim,)).fetchall()
+
+
+def finish_care_status_updates(updates: List[sqlite3.Row], unfinished_errors: dict):
+    now = time.time()
+    connection = get_update_queue_connection()
+    with connection:
+        connection.executemany('DELETE FROM care_status_updates WHERE seq = ? AND claim = ?', [
+            (update['seq'], update['claim']) for update in updates if update['citizen_id'] not in unfinished_errors])
+        for update in updates:
+            error = unfinished_errors.get(update['citizen_id'])
+            if error is None:
+                continue
+            given_up = update['attempts'] >= UPDATE_QUEUE_MAX_ATTEMPTS
+            connection.execute(
+                'UPDATE care_status_updates SET status = ?, next_attempt_at = ?, claim = NULL, error = ? ' +
+                'WHERE seq = ? AND claim = ?',
+                (UPDATE_FAILED if given_up else UPDATE_PENDING,
+                 now + UPDATE_QUEUE_RETRY_BACKOFF * 2 ** (update['attempts'] - 1), error,
+                 update['seq'], update['claim']))
+            if given_up:
+                logging.error(f"Gave up updating the care status of {update['citizen_id']} after " +
+                              f"{update['attempts']} attempts: {error}")
+
+
+async def flush_care_status_updates(updates: List[sqlite3.Row]):
+    unfinished_errors = {}
+    # Updates claimed before may already have been written by a worker that stopped before removing them, so they
+    # are matched against Airtable itself rather than the replica or citizen index, whose Notes may be stale
+    for read_from_airtable in (False, True):
+        batch = [update for update in updates if (update['attempts'] > 1) == read_from_airtable]
+        if len(batch) == 0:
+            continue
+        try:
+            content, _ = await process_care_provided_report(
+                [CareProvidedReport(citizen_id=update['citizen_id'], care_provider_name=update['care_provider_name'])
+                 for update in batch],
+                reported_at={update['citizen_id']: datetime.datetime.fromtimestamp(update['reported_at'], TIMEZONE)
+                             for update in batch},
+                read_from_airtable=read_from_airtable)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error('Unable to flush care status updates', exc_info=e)
+            unfinished_errors.update({update['citizen_id']: repr(e) for update in batch})
+            continue
+        unfinished_errors.update({report['citizen_id']: 'No single matching care request'
+                                  for report in content['skipped']})
+        unfinished_errors.update({report['citizen_id']: 'Airtable update failed' for report in content['failed']})
+        care_status_updates_total.inc(len(content['updated']), result='written')
+
+    care_status_updates_total.inc(len(unfinished_errors), result='retried')
+    finish_care_status_updates(updates, unfinished_errors)
+
+
+async def run_care_status_update_queue():
+    while True:
+        try:
+            updates = claim_care_status_updates()
+            while len(updates) > 0:
+                await flush_care_status_updates(updates)
+                updates = claim_care_status_updates()
+        except Exception as e:
+            logging.error('Unable to claim care status updates', exc_info=e)
+        await asyncio.sleep(UPDATE_QUEUE_POLL_INTERVAL)
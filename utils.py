@@ -1,4 +1,133 @@
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+from email.utils import parsedate_to_datetime
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import dotenv
+
+dotenv.load_dotenv()
+
+# Default home of the SQLite files the API workers and services share, next to the code rather than in whichever
+# directory a process happens to be started from
+DATA_DIRECTORY = os.environ.get('DATA_DIRECTORY', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data'))
+# SQLite's default limit on the number of ? placeholders in a statement is 999, queries stay well below it
+SQLITE_MAX_VARIABLES = 500
+
+UTC = datetime.timezone.utc
+
+
+def connect_sqlite(path: str, schema: str = '') -> sqlite3.Connection:
+    # Shared by the API workers and services, each through connections that may be used from the threadpool
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    connection.row_factory = sqlite3.Row
+    connection.execute('PRAGMA journal_mode=WAL')
+    if schema:
+        connection.executescript(schema)
+    return connection
+
+
+def iter_chunks(values: List, size: int = SQLITE_MAX_VARIABLES) -> Iterator[List]:
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def build_in_clause(column: str, values: List) -> Tuple[str, List]:
+    return f"{column} IN ({','.join('?' * len(values))})", list(values)
+
 
 def hyphenate_citizen_id(unhyphenated_id: str) -> str:
     return (f"{unhyphenated_id[0]}-{unhyphenated_id[1:5]}-{unhyphenated_id[5:10]}" +
             f"-{unhyphenated_id[10:12]}-{unhyphenated_id[12]}")
+
+
+def iter_json_array(chunks: Iterable[str]) -> Iterator:
+    # Yields the items of a top-level JSON array as they arrive, so that the whole document is never held in memory
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    started = False
+    chunks = iter(chunks)
+    exhausted = False
+
+    while True:
+        while position < len(buffer) and buffer[position] in ' \t\r\n' + (',' if started else ''):
+            position += 1
+        if position < len(buffer):
+            if not started:
+                if buffer[position] != '[':
+                    raise ValueError('Expected a JSON array')
+                started = True
+                position += 1
+                continue
+            if buffer[position] == ']':
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if exhausted:
+                    raise
+            else:
+                # An item running up to the end of the buffer (e.g. a number) may continue in the next chunk
+                if end < len(buffer) or exhausted:
+                    yield item
+                    position = end
+                    continue
+        elif exhausted:
+            raise ValueError('Unexpected end of JSON array')
+
+        try:
+            chunk = next(chunks)
+        except StopIteration:
+            exhausted = True
+        else:
+            buffer = buffer[position:] + chunk
+            position = 0
+
+
+def build_etag(*parts: bytes) -> str:
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update(part)
+    # Weak, because the compressed and uncompressed representations share it
+    return f'W/"{digest.hexdigest()}"'
+
+
+def is_not_modified(if_none_match: Optional[str], if_modified_since: Optional[str], etag: str,
+                    last_modified: Optional[float] = None) -> bool:
+    # If-None-Match takes precedence over If-Modified-Since, and is compared weakly
+    if if_none_match:
+        return any(tag.strip() == '*' or tag.strip().replace('W/', '', 1) == etag.replace('W/', '', 1)
+                   for tag in if_none_match.split(','))
+    if if_modified_since and last_modified is not None:
+        try:
+            return int(last_modified) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def parse_byte_range(range_header: str, size: int) -> Optional[Tuple[int, int]]:
+    # The first and last byte positions of a single "bytes=" range, None when the header cannot be used (the whole
+    # file is sent instead) and ValueError when the range is unsatisfiable
+    unit, _, ranges = range_header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in ranges:
+        return None
+    first, _, last = ranges.strip().partition('-')
+    try:
+        if first:
+            first = int(first)
+            # A last position before the first makes the range invalid rather than unsatisfiable (RFC 9110)
+            if last and int(last) < first:
+                return None
+            last = min(int(last) if last else size - 1, size - 1)
+        else:
+            first, last = max(0, size - int(last)), size - 1
+    except ValueError:
+        return None
+    if first < 0 or first > last:
+        raise ValueError(f'Unsatisfiable range {range_header}')
+    return first, last